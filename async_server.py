@@ -0,0 +1,285 @@
+import asyncio
+import time
+
+import protocol
+from files import read_chunk
+from outbox import Outbox
+from server import Server, parse_args, server_options
+
+
+# one protocol instance per connected client, driven by the event loop;
+# reads land directly in the server's shared receive buffer
+class ChatProtocol(asyncio.BufferedProtocol):
+    __slots__ = ("server", "transport", "addr", "id", "nickname", "room", "decoder", "outbox", "paused", "deadline",
+                 "connected_at", "last_seen", "pinged_at", "bytes_in", "messages_in", "limit",
+                 "backlog", "held", "resume_handle", "compress", "downloads", "pump_handle")
+
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.addr = None
+        self.id = None
+        self.nickname = None
+        self.room = None
+        # small frames only until the handshake is accepted
+        self.decoder = protocol.FrameDecoder(protocol.MAX_HANDSHAKE)
+        self.outbox = Outbox(server.queue_limit, server.overflow, server.block_timeout)
+        self.paused = False
+        self.deadline = None
+        self.connected_at = self.last_seen = time.monotonic()
+        self.pinged_at = None
+        self.bytes_in = 0
+        self.messages_in = 0
+        self.limit = server.rate_limit()
+        # frames read before the client went over its rate limit, handled once the limit allows
+        self.backlog = None
+        # set while the server works on something for the client off the loop, it isn't read from meanwhile
+        self.held = False
+        self.resume_handle = None
+        self.compress = False
+        # files being sent to the client, one chunk at a time while the transport keeps up;
+        # pump_handle is the read of the next chunk on the default executor
+        self.downloads = []
+        self.pump_handle = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.addr = transport.get_extra_info("peername")
+        self.server.registry.assign_id(self)
+        if self.server.metrics is not None:
+            self.server.metrics.inc("connections_accepted")
+        transport.write(self.server.greeting)
+        if self.server.heartbeat is not None:
+            self.server.heartbeat.watch(self)
+
+    # writes straight to the transport until it pushes back or a flush window is set, otherwise queues
+    # in the outbox; the loop can't block, so a full BLOCK queue gets the timeout to drain before it is dropped
+    # and wait is ignored
+    def send(self, data, wait=True):
+        if not self.paused and not self.outbox.frames and not self.server.flush_window:
+            self.transport.write(data)
+            return
+        if not self.outbox.put(data, wait=False) and self.deadline is None:
+            self.deadline = self.server.loop.call_later(self.outbox.timeout, self.check_drained)
+        if self.paused:
+            return
+        if self.outbox.bytes >= self.server.flush_bytes:
+            self.flush()
+        else:
+            self.server.schedule_flush(self)
+
+    # reads size bytes of a file from offset off the loop and writes them as a chunk once they are in,
+    # chat traffic gets in between chunks and the next one is only read then
+    def send_chunk(self, transfer, offset, size):
+        self.pump_handle = self.server.loop.run_in_executor(None, read_chunk, transfer, offset, size)
+        self.pump_handle.add_done_callback(lambda future: self.chunk_read(transfer, offset, future))
+
+    def chunk_read(self, transfer, offset, future):
+        if self.transport.is_closing():
+            return
+        try:
+            data = future.result()
+        except OSError as e:
+            self.server.disconnect(self, str(e))
+            return
+        self.flush()
+        self.transport.write(protocol.encode_chunk(transfer.id, offset, data))
+        self.pump()
+
+    def bulk_room(self):
+        return not self.paused and self.pump_handle is None and not self.transport.is_closing()
+
+    def pump(self):
+        self.pump_handle = None
+        if self.downloads:
+            self.server.files.pump(self)
+
+    # hands everything queued to the transport in a single write
+    def flush(self):
+        if not self.paused and self.outbox.frames:
+            self.transport.writelines(self.outbox.take_all())
+
+    def check_drained(self):
+        self.deadline = None
+        if len(self.outbox) >= self.outbox.limit:
+            self.server.disconnect(self, "outbound queue stayed full for {}s".format(self.outbox.timeout))
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self.flush()
+        if self.downloads:
+            self.server.files.pump(self)
+
+    def close(self, flush=True):
+        if flush:
+            self.flush()
+        self.outbox.close()
+        if self.deadline is not None:
+            self.deadline.cancel()
+        if self.pump_handle is not None:
+            self.pump_handle.cancel()
+        if flush:
+            self.transport.close()
+        else:
+            self.transport.abort()
+
+    def get_buffer(self, sizehint):
+        return self.server.buffer
+
+    def buffer_updated(self, nbytes):
+        self.last_seen = time.monotonic()
+        self.bytes_in += nbytes
+        if self.server.metrics is not None:
+            self.server.metrics.inc("bytes_in", nbytes)
+        try:
+            self.process(self.server.unpack(self, self.decoder.decode(self.server.buffer[:nbytes])))
+        except protocol.ProtocolError as e:
+            self.reject(e)
+
+    # hands an iterator of frames to the server; once the client is over its rate limit, or held while the server
+    # works on a frame off the loop, the rest is put aside and the connection is not read from until the debt
+    # is paid and the work is done, so TCP slows the sender down
+    def process(self, frames):
+        for kind, frame in frames:
+            self.server.receive(self, kind, frame)
+            delay = 0.0
+            if self.limit is not None and kind != protocol.CHUNK:
+                delay = self.server.throttle(self, 1, len(frame))
+            if self.transport.is_closing():
+                return
+            if delay or self.held:
+                # the frames still point into the shared receive buffer, keep copies
+                self.backlog = [(kind, bytes(frame)) for kind, frame in frames]
+                self.transport.pause_reading()
+                if delay:
+                    self.resume_handle = self.server.loop.call_later(delay, self.resume)
+                return
+
+    # goes on with the frames put aside once the work the client was held for is done
+    def release(self):
+        self.held = False
+        if self.resume_handle is not None:
+            return
+        if self.backlog is not None:
+            self.resume()
+        else:
+            self.transport.resume_reading()
+
+    def resume(self):
+        self.resume_handle = None
+        if self.transport.is_closing() or self.held:
+            return
+        frames, self.backlog = self.backlog, None
+        try:
+            self.process(iter(frames))
+        except protocol.ProtocolError as e:
+            self.reject(e)
+            return
+        if self.backlog is None:
+            self.transport.resume_reading()
+
+    def reject(self, error):
+        if self.server.metrics is not None:
+            self.server.metrics.inc("protocol_errors")
+        self.send(protocol.encode_frame(protocol.ERROR, str(error).encode()))
+        self.server.disconnect(self, str(error), flush=True)
+
+    def connection_lost(self, exc):
+        self.server.disconnect(self, str(exc) if exc else "connection closed")
+
+
+# single-threaded server engine serving every connection from one asyncio event loop
+class AsyncServer(Server):
+    def __init__(self, host, port, peers, display=print, **options):
+        super().__init__(host, port, peers, display=display, **options)
+        self.loop = None
+        # every connection is read on the loop thread, so one receive buffer serves them all
+        self.buffer = memoryview(bytearray(protocol.READ_SIZE))
+        # connections with frames waiting for the coalescing window, flushed together by one timer
+        self.dirty = set()
+        self.flush_handle = None
+
+    def schedule_flush(self, client):
+        self.dirty.add(client)
+        if self.flush_handle is None:
+            self.flush_handle = self.loop.call_later(self.flush_window, self.flush_dirty)
+
+    def flush_dirty(self):
+        self.flush_handle = None
+        dirty, self.dirty = self.dirty, set()
+        for client in dirty:
+            client.flush()
+
+    # the loop turns the heartbeat wheel, no extra thread needed
+    def start_heartbeat(self):
+        self.loop.call_soon(self.turn_wheel)
+
+    def turn_wheel(self):
+        self.heartbeat.tick()
+        self.loop.call_later(self.heartbeat.wheel.tick, self.turn_wheel)
+
+    # history and search lookups could stall the loop, so they run on the default executor
+    def lookup(self, client, usage, reply, function, *args):
+        def done(future):
+            if isinstance(future.exception(), ValueError):
+                self.notice(client, usage)
+            elif future.exception() is not None:
+                self.display("Lookup failed: {}".format(future.exception()))
+            elif not client.transport.is_closing():
+                reply(client, future.result())
+
+        self.loop.run_in_executor(None, function, *args).add_done_callback(done)
+
+    # packing a replay or reading and writing files could stall the loop as well, so it runs on the default
+    # executor and the client is held until then(result) has run back on the loop
+    def offload(self, client, then, function, *args):
+        def done(future):
+            if client.transport.is_closing():
+                return
+            try:
+                then(future.result())
+            except protocol.ProtocolError as e:
+                client.reject(e)
+                return
+            except OSError as e:
+                self.disconnect(client, str(e))
+                return
+            client.release()
+
+        client.held = True
+        client.transport.pause_reading()
+        self.loop.run_in_executor(None, function, *args).add_done_callback(done)
+
+    # event loop is not thread-safe, so hand the broadcast over to its thread
+    def announce(self, msg):
+        self.loop.call_soon_threadsafe(self.broadcast, msg)
+
+    # messages from linked servers arrive on the links' threads as well
+    def federated(self, room, text):
+        self.loop.call_soon_threadsafe(self.record, room, text)
+
+    async def serve(self, soc):
+        self.loop = asyncio.get_running_loop()
+        if self.bus_path is not None:
+            from workers import AsyncBusLink
+            _, self.bus = await self.loop.create_unix_connection(lambda: AsyncBusLink(self), self.bus_path)
+        if self.heartbeat is not None:
+            self.start_heartbeat()
+        if self.federation_port or self.links:
+            self.start_federation()
+        server = await self.loop.create_server(lambda: ChatProtocol(self), sock=soc)
+        async with server:
+            await server.serve_forever()
+
+    # runs the event loop on the calling thread
+    def main(self, soc):
+        asyncio.run(self.serve(soc))
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    server = AsyncServer(args.host, args.port, args.peers, **server_options(args))
+    server.run()
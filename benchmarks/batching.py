@@ -0,0 +1,79 @@
+import argparse
+import asyncio
+import json
+import time
+
+from bot import LatencyBot, connect
+from loadgen import latency_summary, process_stats, raise_fd_limit, spawn_server
+from server import ENGINES
+
+
+# sends bursts of stamped messages and collects what the receivers measured
+async def run_bursts(args, pid):
+    bots = [await connect(args.host, args.port, "bot0", retry_for=10.0, factory=LatencyBot)]
+    for i in range(1, args.clients):
+        bots.append(await connect(args.host, args.port, "bot{}".format(i), factory=LatencyBot))
+    await asyncio.sleep(1.0)
+    for bot in bots:
+        del bot.latencies[:]
+        bot.received = 0
+
+    cpu_before = process_stats(pid).get("cpu_seconds", 0)
+    for _ in range(args.bursts):
+        for bot in bots[:args.senders]:
+            for _ in range(args.burst):
+                bot.say_stamped(args.size)
+        await asyncio.sleep(args.interval)
+
+    expected = args.bursts * args.senders * args.burst * args.clients
+    deadline = time.monotonic() + args.timeout
+    while sum(bot.received for bot in bots) < expected and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    stats = process_stats(pid)
+
+    latencies = [latency for bot in bots for latency in bot.latencies]
+    for bot in bots:
+        bot.transport.close()
+    result = {
+        "delivered": len(latencies),
+        "expected": expected,
+        "server_cpu_seconds": round(stats.get("cpu_seconds", 0) - cpu_before, 2),
+    }
+    result.update(latency_summary(latencies))
+    return result
+
+
+def bench_window(engine, window, args):
+    proc = spawn_server(engine, args.host, args.port, args.clients, ["--flush-window", str(window)])
+    try:
+        result = asyncio.run(run_bursts(args, proc.pid))
+        result.update({"engine": engine, "flush_window": window})
+        return result
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fan-out latency and server CPU with and without a coalescing window")
+    parser.add_argument("--engine", choices=ENGINES, action="append")
+    parser.add_argument("--window", type=float, action="append", help="flush windows to compare, seconds")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=23456)
+    parser.add_argument("--clients", type=int, default=100)
+    parser.add_argument("--senders", type=int, default=10)
+    parser.add_argument("--burst", type=int, default=5, help="messages per sender per burst")
+    parser.add_argument("--bursts", type=int, default=20)
+    parser.add_argument("--interval", type=float, default=0.05, help="seconds between bursts")
+    parser.add_argument("--size", type=int, default=64)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    args = parser.parse_args(argv)
+
+    raise_fd_limit()
+    for engine in args.engine or ENGINES:
+        for window in args.window or (0.0, 0.002):
+            print(json.dumps(bench_window(engine, window, args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import argparse
+import json
+import queue
+import socket
+import threading
+import time
+
+import protocol
+from client import BATCH_LIMIT, QUEUE_LIMIT, take_pending
+
+
+# old path: one frame and one sendall per queued line
+def send_each(sock, lines, nickname):
+    sock.sendall(protocol.encode_input(nickname, lines.get()))
+    return 1
+
+
+# batched path: everything queued leaves in one sendall
+def send_batch(sock, lines, nickname):
+    pending = take_pending(lines, BATCH_LIMIT)
+    sock.sendall(b"".join(protocol.encode_input(nickname, line) for line in pending))
+    return len(pending)
+
+
+# a producer thread queues lines as fast as it can while a writer sends them with one of the paths
+# to a reader draining the other end of a socket pair; returns throughput and writes per line
+def measure(path, messages, size):
+    left, right = socket.socketpair()
+    expected = messages * (protocol.HEADER.size + len("bot: ") + size)
+
+    def drain():
+        received = 0
+        while received < expected:
+            received += len(right.recv(1 << 20))
+
+    reader = threading.Thread(target=drain)
+    reader.start()
+    lines = queue.Queue(QUEUE_LIMIT)
+    line = "x" * size
+
+    def produce():
+        for _ in range(messages):
+            lines.put(line)
+
+    producer = threading.Thread(target=produce)
+    start = time.perf_counter()
+    cpu = time.process_time()
+    producer.start()
+    writes = 0
+    sent = 0
+    while sent < messages:
+        sent += path(left, lines, "bot")
+        writes += 1
+    reader.join()
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu
+    producer.join()
+    left.close()
+    right.close()
+    return {
+        "messages_per_second": round(messages / elapsed),
+        "cpu_us_per_message": round(cpu / messages * 1e6, 2),
+        "writes_per_message": round(writes / messages, 3),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Throughput of the client send path, one write per line or batched")
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--size", type=int, action="append", help="line sizes to compare")
+    args = parser.parse_args(argv)
+
+    for size in args.size or (32, 200, 2000):
+        for name, path in (("each", send_each), ("batch", send_batch)):
+            result = measure(path, args.messages, size)
+            result.update({"path": name, "size": size, "messages": args.messages})
+            print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
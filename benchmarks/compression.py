@@ -0,0 +1,93 @@
+import argparse
+import json
+import random
+import time
+import zlib
+
+import protocol
+
+CHAT_LINE = "alice: did anyone look at the build yet? it failed again on the windows runner"
+WORDS = ("the build failed again because the cache was stale and nobody noticed until the release "
+         "branch was cut so we should pin the version and add a check that runs before every merge").split()
+
+
+# a few paragraphs of prose, like a log or a message someone pasted
+def pasted_text(size, seed=1):
+    rng = random.Random(seed)
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return "bob: " + " ".join(words)[:size]
+
+
+# a HISTORY frame of about size bytes of sequenced chat messages
+def history_batch(size):
+    rng = random.Random(2)
+    messages = bytearray()
+    seq = 1
+    while len(messages) < size:
+        text = "{}: {}".format(rng.choice(("alice", "bob", "carol")), " ".join(rng.sample(WORDS, 8)))
+        messages += protocol.encode_message(seq, text.encode())
+        seq += 1
+    return protocol.encode_frame(protocol.HISTORY, bytes(messages))
+
+
+def deflate(frame, level, dictionary):
+    if dictionary:
+        deflater = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=protocol.DICTIONARY)
+    else:
+        deflater = zlib.compressobj(level, zlib.DEFLATED, -15)
+    return deflater.compress(frame) + deflater.flush()
+
+
+def inflate(data, dictionary):
+    if dictionary:
+        inflater = zlib.decompressobj(-15, zdict=protocol.DICTIONARY)
+    else:
+        inflater = zlib.decompressobj(-15)
+    return inflater.decompress(data)
+
+
+# CPU cost per frame of compressing and decompressing one frame, and the size it shrinks to
+def measure(frame, level, dictionary, rounds):
+    start = time.process_time()
+    for _ in range(rounds):
+        data = deflate(frame, level, dictionary)
+    compress = time.process_time() - start
+    start = time.process_time()
+    for _ in range(rounds):
+        inflate(data, dictionary)
+    decompress = time.process_time() - start
+    return {
+        "compress_us_per_frame": round(compress / rounds * 1e6, 2),
+        "decompress_us_per_frame": round(decompress / rounds * 1e6, 2),
+        "bytes": len(frame),
+        "compressed_bytes": len(data) + protocol.HEADER.size,
+        "ratio": round((len(data) + protocol.HEADER.size) / len(frame), 3),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cost and gain of compressing frames at different levels")
+    parser.add_argument("--level", type=int, action="append")
+    parser.add_argument("--rounds", type=int, default=2000)
+    parser.add_argument("--history-size", type=int, default=64 * 1024)
+    args = parser.parse_args(argv)
+
+    frames = (("chat_line", protocol.encode_text(CHAT_LINE)),
+              ("pasted_text", protocol.encode_text(pasted_text(4096))),
+              ("history_batch", history_batch(args.history_size)))
+    for name, frame in frames:
+        rounds = max(10, args.rounds * 1024 // max(1024, len(frame)))
+        for level in args.level or (1, 6, 9):
+            for dictionary in (False, True):
+                result = measure(frame, level, dictionary, rounds)
+                result.update({"frame": name, "level": level, "dictionary": dictionary})
+                print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
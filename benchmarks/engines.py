@@ -0,0 +1,84 @@
+import argparse
+import asyncio
+import json
+import time
+
+import protocol
+from bot import Bot, connect
+from loadgen import process_stats, raise_fd_limit, spawn_server
+from server import ENGINES
+
+
+async def run_clients(host, port, clients, senders, messages, size, timeout, pid=None):
+    bots = [await connect(host, port, "bot0", retry_for=10.0, factory=Bot)]
+    start = time.perf_counter()
+    for i in range(1, clients):
+        bots.append(await connect(host, port, "bot{}".format(i)))
+    connect_time = time.perf_counter() - start
+
+    # let the "connected to the chat" announcements settle before measuring
+    await asyncio.sleep(1.0)
+    for bot in bots:
+        bot.received = 0
+
+    payload = "x" * size
+    expected = senders * messages * clients
+    start = time.perf_counter()
+    for bot in bots[:senders]:
+        frame = protocol.encode_input(bot.nickname, payload)
+        bot.transport.write(frame * messages)
+        await asyncio.sleep(0)
+
+    deadline = start + timeout
+    while sum(bot.received for bot in bots) < expected and time.perf_counter() < deadline:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    delivered = sum(bot.received for bot in bots)
+    stats = process_stats(pid) if pid else {}
+
+    for bot in bots:
+        bot.transport.close()
+    return dict(stats, **{
+        "clients": clients,
+        "connect_seconds": round(connect_time, 4),
+        "connects_per_second": round(clients / connect_time, 1),
+        "delivered": delivered,
+        "expected": expected,
+        "complete": delivered >= expected,
+        "fanout_seconds": round(elapsed, 4),
+        "deliveries_per_second": round(delivered / elapsed, 1),
+    })
+
+
+# starts a server with the given engine in its own process and drives load against it
+def bench_engine(engine, args):
+    proc = spawn_server(engine, args.host, args.port, args.clients)
+    try:
+        result = asyncio.run(run_clients(args.host, args.port, args.clients, args.senders,
+                                         args.messages, args.size, args.timeout, proc.pid))
+        result["engine"] = engine
+        return result
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the threaded and asyncio server engines")
+    parser.add_argument("--engine", choices=ENGINES, action="append")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=23456)
+    parser.add_argument("--clients", type=int, default=500)
+    parser.add_argument("--senders", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--size", type=int, default=64)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    args = parser.parse_args(argv)
+
+    raise_fd_limit()
+    for engine in args.engine or ENGINES:
+        print(json.dumps(bench_engine(engine, args)))
+
+
+if __name__ == "__main__":
+    main()
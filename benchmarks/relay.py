@@ -0,0 +1,94 @@
+import argparse
+import json
+import socket
+import threading
+import time
+import tracemalloc
+
+import protocol
+from outbox import Outbox
+from server import send_gathered
+
+
+# old path: decode every chat frame to str, then frame it again for every recipient
+def decode_path(frames, outboxes):
+    for _, frame in frames:
+        msg = bytes(protocol.payload_of(frame)).decode()
+        for outbox in outboxes:
+            outbox.put(protocol.encode_text(msg))
+
+
+# relay path: copy the received frame once and let every recipient share it
+def relay_path(frames, outboxes):
+    for _, frame in frames:
+        data = bytes(frame)
+        for outbox in outboxes:
+            outbox.put(data)
+
+
+# runs one fan-out path over a buffer of received frames, returns CPU and memory cost per message
+def measure(path, wire, recipients, messages):
+    outboxes = [Outbox(limit=messages + 1) for _ in range(recipients)]
+    frames = protocol.FrameDecoder().decode(memoryview(wire))
+
+    start = time.process_time()
+    path(frames, outboxes)
+    cpu = time.process_time() - start
+    for outbox in outboxes:
+        outbox.take_all()
+
+    tracemalloc.start()
+    path(frames, outboxes)
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "cpu_us_per_message": round(cpu / messages * 1e6, 2),
+        "bytes_retained_per_message": round(retained / messages),
+    }
+
+
+# compares one joined sendall against a scatter-gather sendmsg for a batch of queued frames
+def measure_writer(frame, batch, rounds):
+    left, right = socket.socketpair()
+
+    def drain():
+        while right.recv(1 << 20):
+            pass
+
+    reader = threading.Thread(target=drain)
+    reader.daemon = True
+    reader.start()
+    frames = [frame] * batch
+    results = {}
+    for name, write in (("join_sendall", lambda: left.sendall(b"".join(frames))),
+                        ("sendmsg", lambda: send_gathered(left, frames))):
+        start = time.process_time()
+        for _ in range(rounds):
+            write()
+        results[name + "_us_per_batch"] = round((time.process_time() - start) / rounds * 1e6, 2)
+    left.close()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-message cost of the relay path versus decode and re-encode")
+    parser.add_argument("--recipients", type=int, action="append")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--size", type=int, default=200)
+    args = parser.parse_args(argv)
+
+    frame = protocol.encode_text("bot: " + "x" * args.size)
+    wire = frame * args.messages
+    for recipients in args.recipients or (100, 1000):
+        for name, path in (("decode", decode_path), ("relay", relay_path)):
+            result = measure(path, wire, recipients, args.messages)
+            result.update({"path": name, "recipients": recipients, "size": args.size})
+            print(json.dumps(result))
+    for size in (args.size, 16 * 1024):
+        result = measure_writer(protocol.encode_text("x" * size), 64, 500)
+        result.update({"path": "writer", "batch": 64, "size": size})
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
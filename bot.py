@@ -0,0 +1,109 @@
+import asyncio
+import time
+from array import array
+
+import protocol
+
+
+# headless chat client driven by an asyncio event loop, for tests, benchmarks and load generation
+class Bot(asyncio.Protocol):
+    # take compressed frames if the server offers them
+    compression = True
+
+    def __init__(self, nickname, room=None, since=None):
+        self.nickname = nickname
+        self.room = room
+        self.since = since
+        self.transport = None
+        self.decoder = protocol.FrameDecoder()
+        # resolved once the handshake reply is sent, or with the reason the server rejected us
+        self.ready = asyncio.get_running_loop().create_future()
+        self.closed = asyncio.get_running_loop().create_future()
+        self.received = 0
+        self.bytes_received = 0
+        self.last_seq = 0
+        self.compress_min = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.bytes_received += len(data)
+        for kind, payload in protocol.expand(self.decoder.feed(data)):
+            if kind == protocol.NICKNAME:
+                if self.compression:
+                    self.compress_min = protocol.compression_offer(payload)
+                compression = protocol.COMPRESSION if self.compress_min else None
+                self.transport.write(protocol.hello(self.nickname, self.room, self.since, compression))
+                self.ready.set_result(None)
+            elif kind in (protocol.MESSAGE, protocol.HISTORY):
+                for seq, text in protocol.decode_messages(kind, payload):
+                    self.last_seq = max(self.last_seq, seq)
+                    self.received += 1
+                    self.message_received(seq, text)
+            elif kind == protocol.PING:
+                self.transport.write(protocol.pong())
+            elif kind == protocol.TEXT:
+                self.notice_received(payload)
+            elif kind == protocol.ERROR and not self.ready.done():
+                self.ready.set_exception(ConnectionError(payload.decode(errors="replace")))
+
+    def connection_lost(self, exc):
+        if not self.ready.done():
+            self.ready.set_exception(exc or ConnectionError("connection closed during handshake"))
+        if not self.closed.done():
+            self.closed.set_result(exc)
+
+    # override to look at every chat message, text is the encoded line
+    def message_received(self, seq, text):
+        pass
+
+    # override to look at messages meant for this bot only
+    def notice_received(self, text):
+        pass
+
+    # sends a line as if it was typed, lines starting with / are commands
+    def say(self, line):
+        frame = protocol.encode_input(self.nickname, line)
+        if self.compress_min and len(frame) >= self.compress_min:
+            frame = protocol.compress(frame)
+        self.transport.write(frame)
+
+    def close(self):
+        self.transport.close()
+
+
+# bot that stamps what it sends with the wall clock and records the latency of every stamped message it receives
+class LatencyBot(Bot):
+    def __init__(self, nickname, room=None, since=None):
+        super().__init__(nickname, room, since)
+        self.latencies = array("d")
+
+    # sends a stamped message padded to roughly size bytes
+    def say_stamped(self, size=0):
+        stamp = "{:.6f}".format(time.time())
+        self.say("{} {}".format(stamp, "x" * max(0, size - len(stamp) - 1)))
+
+    def message_received(self, seq, text):
+        _, _, rest = bytes(text).partition(b": ")
+        try:
+            sent = float(rest.split(b" ", 1)[0])
+        except ValueError:
+            return
+        self.latencies.append(time.time() - sent)
+
+
+# connects a bot and waits for the handshake, retrying while a freshly started server is not listening yet
+async def connect(host, port, nickname, room=None, since=None, retry_for=0.0, factory=Bot):
+    loop = asyncio.get_running_loop()
+    deadline = time.monotonic() + retry_for
+    while True:
+        try:
+            _, bot = await loop.create_connection(lambda: factory(nickname, room, since), host, port)
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            await asyncio.sleep(0.05)
+            continue
+        await bot.ready
+        return bot
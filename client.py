@@ -1,13 +1,47 @@
+import queue
 import socket
 import threading
 
+import protocol
+from transfers import FileTransfers
+
+# lines waiting to be sent, and the most one write takes from the queue; a write may be compressed
+# as a whole, so it takes no more lines than a COMPRESSED frame may carry
+QUEUE_LIMIT = 1024
+BATCH_LIMIT = protocol.MAX_COMPRESSED_FRAMES
+
+
+# waits for the first queued item (with block=False returns at once if there is none)
+# and takes whatever else is already waiting, up to limit items
+def take_pending(items, limit=BATCH_LIMIT, block=True):
+    try:
+        pending = [items.get(block)]
+    except queue.Empty:
+        return []
+    while len(pending) < limit:
+        try:
+            pending.append(items.get_nowait())
+        except queue.Empty:
+            break
+    return pending
+
 
 class Client:
     def __init__(self, host, port):
         self.host = host
         self.port = port
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.nickname = input("Nickname: ")
+        # the receive thread answers heartbeats while the write thread sends, one frame at a time
+        self.send_lock = threading.Lock()
+        self.last_seq = 0
+        # frames from this size on are sent compressed, 0 until the server offers compression
+        self.compress_min = 0
+        # set once the handshake went out, nothing else may be sent before it
+        self.joined = threading.Event()
+        self.message_queue = queue.Queue(QUEUE_LIMIT)
+        # /send <path> uploads a file, /get <id> downloads one into ./downloads
+        self.files = FileTransfers()
+        self.nickname = input("Nickname: ").strip()
         try:
             self.client_socket.connect((host, port))
             print("Successfully connected to {}".format(self.client_socket.getpeername()))
@@ -18,23 +52,93 @@ class Client:
         receive_thread.start()
         write_thread = threading.Thread(target=self.write)
         write_thread.start()
+        input_thread = threading.Thread(target=self.read_input)
+        input_thread.start()
 
     def receive(self):
+        decoder = protocol.FrameDecoder()
         while True:
             try:
-                msg = self.client_socket.recv(1024).decode()
-                if msg == "NICKNAME":
-                    self.client_socket.sendall(self.nickname.encode())
-                    continue
-                print(msg)
-            except socket.error:
+                data = self.client_socket.recv(protocol.READ_SIZE)
+                if not data:
+                    break
+                for kind, payload in protocol.expand(decoder.feed(data)):
+                    if kind == protocol.NICKNAME:
+                        self.compress_min = protocol.compression_offer(payload)
+                        compression = protocol.COMPRESSION if self.compress_min else None
+                        self.send(protocol.hello(self.nickname, since=self.last_seq, compression=compression))
+                        for frame in self.files.reoffer():
+                            self.send(frame)
+                        self.joined.set()
+                    elif kind == protocol.PING:
+                        self.send(protocol.pong())
+                    elif kind == protocol.TEXT:
+                        print(payload.decode(errors="replace"))
+                    elif kind == protocol.OFFER:
+                        self.files.offered(payload)
+                    elif kind == protocol.RESUME:
+                        self.files.resumed(payload)
+                        self.wake_writer()
+                    elif kind == protocol.CHUNK:
+                        path = self.files.received(payload)
+                        if path is not None:
+                            print("Saved {}".format(path))
+                    elif kind in (protocol.MESSAGE, protocol.HISTORY):
+                        for seq, text in protocol.decode_messages(kind, payload):
+                            self.last_seq = max(self.last_seq, seq)
+                            print(text.decode(errors="replace"))
+                    elif kind == protocol.ERROR:
+                        print("Connection rejected: {}".format(payload.decode(errors="replace")))
+            except (socket.error, protocol.ProtocolError):
                 print("An error occurred...")
                 break
 
+    def read_input(self):
+        while True:
+            try:
+                line = input("")
+            except EOFError:
+                break
+            self.add_to_queue(line)
+
+    # sends everything queued since the last write as one batch of frames, then a chunk of a file being
+    # uploaded; chat never waits for more than one chunk
     def write(self):
+        self.joined.wait()
         while True:
-            msg = "{}: {}".format(self.nickname, input(""))
-            self.client_socket.sendall(msg.encode())
+            lines = take_pending(self.message_queue, block=not self.files.sending())
+            data = b"".join(self.encode_line(line) for line in lines if line is not None)
+            if data:
+                self.send(data)
+            chunk = self.files.next_chunk()
+            if chunk is not None:
+                self.send(chunk, compress=False)
+
+    def encode_line(self, line):
+        frame = self.files.command(line)
+        return frame if frame is not None else protocol.encode_input(self.nickname, line)
+
+    # lets a write thread waiting for lines know an upload can go on
+    def wake_writer(self):
+        try:
+            self.message_queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def send(self, data, compress=True):
+        if compress and self.compress_min and len(data) >= self.compress_min:
+            data = protocol.compress(data)
+        with self.send_lock:
+            self.client_socket.sendall(data)
+
+    # queues a line for the write thread; with block=False, or once timeout runs out, a full queue
+    # leaves the line out and returns False so the caller can slow down
+    def add_to_queue(self, msg, block=True, timeout=None):
+        try:
+            self.message_queue.put(msg, block, timeout)
+        except queue.Full:
+            return False
+        return True
 
 
 if __name__ == "__main__":
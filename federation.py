@@ -0,0 +1,296 @@
+import collections
+import ipaddress
+import itertools
+import os
+import socket
+import threading
+import time
+
+import protocol
+from outbox import DISCONNECT, Outbox, Overflow
+from server import send_buffers
+
+# messages a link may have waiting before it is considered stuck and dropped
+LINK_QUEUE_LIMIT = 64 * 1024
+# nodes a message may pass through before it is no longer passed on
+MAX_HOPS = 16
+# seconds between attempts to reach a peer that is down, growing up to the maximum
+RETRY_DELAY = 0.5
+MAX_RETRY_DELAY = 30.0
+
+
+# the message ids seen most recently, a bounded window of (origin, id) pairs
+class Seen:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.ids = set()
+        self.order = collections.deque()
+        self.lock = threading.Lock()
+
+    # remembers a message id, returns False if it was already there
+    def add(self, key):
+        with self.lock:
+            if key in self.ids:
+                return False
+            self.ids.add(key)
+            self.order.append(key)
+            if len(self.order) > self.capacity:
+                self.ids.discard(self.order.popleft())
+            return True
+
+    def __len__(self):
+        return len(self.ids)
+
+
+# links this server to other chat servers so clients on any of them share one chat; every message a
+# node publishes is sent to its peers with the path it took, a node never passes a message back to a node
+# on its path and delivers any (origin, id) only once, so messages reach every node once however they are linked
+class Federation:
+    def __init__(self, server, node, listen=None, peers=(), window=0.005, batch_bytes=64 * 1024,
+                 seen=100000, secret=None):
+        self.server = server
+        self.node = node
+        self.listen = listen
+        self.peers = peers
+        # shared by the linked nodes, sent in the handshake and required from every peer if set
+        self.secret = secret
+        # links wait up to window seconds for more messages, up to batch_bytes, and send them in one frame
+        self.window = window
+        self.batch_bytes = batch_bytes
+        self.seen = Seen(seen)
+        # ids start at the clock, so a restarted node doesn't reuse ids its peers still remember
+        self.ids = itertools.count(time.time_ns() // 1000)
+        self.links = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        if self.listen is not None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(self.listen)
+            sock.listen()
+            self.server.display("Federation link port at {}".format(sock.getsockname()))
+            if self.secret is None and not ipaddress.ip_address(sock.getsockname()[0]).is_loopback:
+                self.server.display("Any host that can reach the federation port can link to it, "
+                                    "set a link secret")
+            self.spawn(self.accept, sock)
+        for address in self.peers:
+            self.spawn(self.dial, address)
+
+    @staticmethod
+    def spawn(target, *args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def accept(self, listener):
+        while True:
+            sock, addr = listener.accept()
+            self.spawn(self.serve_link, sock, addr)
+
+    # keeps a link to one peer up, connecting again whenever it goes down or couldn't be set up; while the
+    # peer is linked through a connection it opened itself there is nothing to dial
+    def dial(self, address):
+        delay = RETRY_DELAY
+        node = None
+        while True:
+            with self.lock:
+                linked = node in self.links
+            if linked:
+                delay = RETRY_DELAY
+                time.sleep(delay)
+                continue
+            try:
+                sock = socket.create_connection(address)
+            except OSError:
+                pass
+            else:
+                link = self.serve_link(sock, address, outbound=True)
+                node = link.node or node
+                if link.writer is not None:
+                    delay = RETRY_DELAY
+            time.sleep(delay)
+            delay = min(MAX_RETRY_DELAY, delay * 2)
+
+    # runs the handshake and the reading side of one link until it closes, returns the link; its writer
+    # is set if the link was up
+    def serve_link(self, sock, addr, outbound=False):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        link = PeerLink(self, sock, addr, outbound)
+        try:
+            link.run()
+        except (protocol.ProtocolError, ValueError) as e:
+            self.server.display("Federation link {} failed: {}".format(link.node or addr, e))
+            link.send_error(str(e))
+        except OSError:
+            pass
+        finally:
+            link.close()
+            if link.writer is not None:
+                link.writer.join()
+            sock.close()
+            with self.lock:
+                if self.links.get(link.node) is link:
+                    del self.links[link.node]
+                    self.server.display("Federation link to {} closed".format(link.node))
+        return link
+
+    # registers a link that finished its handshake; two nodes that dialed each other keep the connection
+    # the node with the smaller name opened, both sides agree on it without talking
+    def add(self, link):
+        if link.node == self.node:
+            raise protocol.ProtocolError("node {} can't link to itself".format(self.node))
+        with self.lock:
+            existing = self.links.get(link.node)
+            if existing is not None and existing.outbound == (self.node < link.node):
+                raise protocol.ProtocolError("already linked to node {}".format(link.node))
+            self.links[link.node] = link
+        if existing is not None:
+            existing.close()
+        self.server.display("Federation link to {} up".format(link.node))
+
+    # passes a message published on this node on to every peer
+    def publish(self, room, text):
+        message_id = next(self.ids)
+        self.seen.add((self.node, message_id))
+        self.forward(protocol.encode_relayed(message_id, (self.node,), room, text), ())
+
+    # takes a batch of messages from a peer: new ones are delivered here and passed on to the peers not on
+    # their path, the ones already seen are dropped
+    def receive(self, entries):
+        for message_id, path, room, text in entries:
+            if self.node in path or not self.seen.add((path[0], message_id)):
+                self.count("federation_duplicates")
+                continue
+            self.count("federation_in")
+            self.server.federated(room, text)
+            if len(path) < MAX_HOPS:
+                self.forward(protocol.encode_relayed(message_id, path + [self.node], room, text), path)
+
+    def forward(self, entry, path):
+        for node, link in list(self.links.items()):
+            if node not in path:
+                self.count("federation_out")
+                link.send(entry)
+
+    def count(self, name):
+        if self.server.metrics is not None:
+            self.server.metrics.inc(name)
+
+    def stats(self):
+        with self.lock:
+            links = {node: dict(link.outbox.stats(), address=str(link.addr), batches=link.batches)
+                     for node, link in self.links.items()}
+        return {"node": self.node, "links": links, "seen": len(self.seen)}
+
+
+# one connection to a peer server; a writer thread sends queued messages in RELAYED batches
+class PeerLink:
+    def __init__(self, federation, sock, addr, outbound):
+        self.federation = federation
+        self.sock = sock
+        self.addr = addr
+        # whether this node opened the connection
+        self.outbound = outbound
+        self.node = None
+        self.outbox = Outbox(LINK_QUEUE_LIMIT, DISCONNECT)
+        self.writer = None
+        self.batches = 0
+
+    # queues a relayed message entry, a peer that can't keep up is dropped and has to link again
+    def send(self, entry):
+        try:
+            self.outbox.put(entry)
+        except Overflow as e:
+            self.federation.server.display("Federation link to {} dropped: {}".format(self.node, e))
+            self.close()
+
+    # both ends send a challenge; the dialing end answers first and the accepting end only answers, and so
+    # names its node, once that answer proved the dialer knows the secret, which never goes on the wire
+    def run(self):
+        federation = self.federation
+        nonce = os.urandom(protocol.LINK_NONCE).hex()
+        self.sock.sendall(protocol.link_request(nonce))
+        decoder = protocol.FrameDecoder(protocol.MAX_HANDSHAKE)
+        buffer = memoryview(bytearray(protocol.READ_SIZE))
+        frames = []
+        kind, frame = self.handshake_frame(decoder, buffer, frames)
+        answer = protocol.link_answer(federation.secret, protocol.parse_link(kind, protocol.payload_of(frame)),
+                                      federation.node)
+        if self.outbound:
+            self.sock.sendall(answer)
+        kind, frame = self.handshake_frame(decoder, buffer, frames)
+        self.node = protocol.parse_link_answer(kind, protocol.payload_of(frame), federation.secret, nonce)
+        if not self.outbound:
+            self.sock.sendall(answer)
+        federation.add(self)
+        decoder.max_payload = protocol.MAX_PAYLOAD
+        self.writer = threading.Thread(target=self.write)
+        self.writer.daemon = True
+        self.writer.start()
+        self.receive(frames)
+        while True:
+            nbytes = self.sock.recv_into(buffer)
+            if not nbytes:
+                return
+            self.receive(decoder.decode(buffer[:nbytes]))
+
+    # the next frame of the handshake, reading more once the ones already decoded are used up
+    def handshake_frame(self, decoder, buffer, frames):
+        while not frames:
+            nbytes = self.sock.recv_into(buffer)
+            if not nbytes:
+                raise ConnectionError("link closed in the handshake")
+            frames.extend(decoder.decode(buffer[:nbytes]))
+        kind, frame = frames.pop(0)
+        if kind == protocol.ERROR:
+            raise protocol.ProtocolError("peer refused the link: {}".format(
+                bytes(protocol.payload_of(frame)).decode(errors="replace")))
+        return kind, frame
+
+    def receive(self, frames):
+        for kind, frame in frames:
+            if kind == protocol.RELAYED:
+                self.federation.receive(protocol.decode_relayed(protocol.payload_of(frame)))
+            elif kind == protocol.ERROR:
+                raise protocol.ProtocolError("peer refused the link: {}".format(
+                    bytes(protocol.payload_of(frame)).decode(errors="replace")))
+
+    # gathers what was queued within the batching window into RELAYED frames of at most batch_bytes
+    def write(self):
+        federation = self.federation
+        while True:
+            entries = self.outbox.get_all(federation.window, federation.batch_bytes)
+            if not entries:
+                break
+            frames = []
+            chunk = []
+            size = 0
+            for entry in entries:
+                if chunk and size + len(entry) > federation.batch_bytes:
+                    frames.append(protocol.encode_frame(protocol.RELAYED, b"".join(chunk)))
+                    chunk = []
+                    size = 0
+                chunk.append(entry)
+                size += len(entry)
+            frames.append(protocol.encode_frame(protocol.RELAYED, b"".join(chunk)))
+            try:
+                send_buffers(self.sock, frames)
+            except OSError:
+                self.close()
+                break
+            self.batches += len(frames)
+
+    def send_error(self, reason):
+        try:
+            self.sock.sendall(protocol.encode_frame(protocol.ERROR, reason.encode()))
+        except OSError:
+            pass
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.outbox.close()
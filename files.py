@@ -0,0 +1,266 @@
+import collections
+import glob
+import json
+import os
+import threading
+import time
+
+import protocol
+
+# file chunks a connection may have queued at a time, the next ones are read from disk as these leave
+WINDOW = 2
+# transfers /files lists
+LISTED = 10
+
+
+# a file shared in a room, spooled to disk as its chunks arrive
+class Transfer:
+    __slots__ = ("id", "name", "size", "owner", "room", "file", "created", "received", "waiting")
+
+    def __init__(self, transfer_id, name, size, owner, room, file, created, received=0):
+        self.id = transfer_id
+        self.name = name
+        self.size = size
+        self.owner = owner
+        self.room = room
+        # unbuffered, read and written at offsets through its descriptor; it stays open for downloads that
+        # are still reading after the transfer was removed and closes with the last reference to it
+        self.file = file
+        self.created = created
+        self.received = received
+        # connections that have sent everything received so far and wait for more
+        self.waiting = set()
+
+    def describe(self):
+        progress = "" if self.received == self.size else ", {}% uploaded".format(self.received * 100 // self.size)
+        return "{} ({}{}) from {}, /get {}".format(self.name, format_size(self.size), progress, self.owner, self.id)
+
+
+# how far one connection is into sending a file
+class Download:
+    __slots__ = ("transfer", "offset")
+
+    def __init__(self, transfer, offset):
+        self.transfer = transfer
+        self.offset = offset
+
+
+# writes a chunk of an upload, the last one is synced to disk; may run off the server's event loop
+def write_chunk(transfer, offset, data):
+    os.pwrite(transfer.file.fileno(), data, offset)
+    if offset + len(data) == transfer.size:
+        os.fsync(transfer.file.fileno())
+
+
+def read_chunk(transfer, offset, size):
+    return os.pread(transfer.file.fileno(), size, offset)
+
+
+def format_size(size):
+    for unit in ("bytes", "KiB", "MiB"):
+        if size < 1024:
+            return "{} {}".format(size, unit)
+        size //= 1024
+    return "{} GiB".format(size)
+
+
+# files shared in the chat: an upload is written to the spool directory chunk by chunk and every download
+# reads it back from there a window of chunks at a time, so no file is ever held in memory and a download can
+# follow an upload that is still running; uploads and downloads carry on from an offset after a disconnect,
+# and transfers survive a restart of the server; the spool holds at most spool_bytes of files, the oldest
+# finished ones make room for new ones, and a file is deleted ttl seconds after it was offered
+class FileShare:
+    def __init__(self, server, directory, max_bytes=64 * 1024 * 1024, spool_bytes=1024 * 1024 * 1024, ttl=86400.0):
+        os.makedirs(directory, exist_ok=True)
+        self.server = server
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.spool_bytes = spool_bytes
+        self.ttl = ttl
+        # by id, in the order they were offered
+        self.transfers = {}
+        self.lock = threading.RLock()
+        loaded = []
+        for path in glob.glob(os.path.join(directory, "*.json")):
+            with open(path) as f:
+                meta = json.load(f)
+            file = open(os.open(path[:-5] + ".data", os.O_RDWR | os.O_CREAT, 0o600), "r+b", buffering=0)
+            received = min(meta["size"], os.fstat(file.fileno()).st_size)
+            created = meta.get("created", os.path.getmtime(path))
+            loaded.append(Transfer(meta["id"], meta["name"], meta["size"], meta["owner"], meta["room"], file,
+                                   created, received))
+        for transfer in sorted(loaded, key=lambda transfer: transfer.created):
+            self.transfers[transfer.id] = transfer
+        with self.lock:
+            self.expire()
+
+    # starts or resumes an upload and tells the uploader where to carry on, a new file is announced to its room
+    def offer(self, client, payload):
+        offer = protocol.parse_offer(payload)
+        transfer_id = offer["id"]
+        # a refusal goes out once the lock is released, sending may block on a full queue
+        refusal = None
+        with self.lock:
+            transfer = self.transfers.get(transfer_id)
+            new = transfer is None
+            if new and offer["size"] > self.max_bytes:
+                refusal = "Files are limited to {}".format(format_size(self.max_bytes))
+            elif new and not self.make_room(offer["size"]):
+                refusal = "The file spool is full, try again later"
+            elif new:
+                transfer = self.create(transfer_id, offer["name"], offer["size"], client)
+            elif transfer.owner != client.nickname or transfer.size != offer["size"]:
+                refusal = "Transfer id {} is taken, pick another one".format(transfer_id)
+        if refusal is not None:
+            self.server.notice(client, refusal)
+            return
+        self.server.send(client, protocol.encode_resume(transfer_id, transfer.received))
+        if new:
+            self.server.deliver(protocol.encode_offer(transfer.id, transfer.name, transfer.size,
+                                                      **{"from": client.nickname}), client.room)
+            self.server.broadcast("{} shares {}".format(client.nickname, transfer.describe()), client.room)
+
+    def create(self, transfer_id, name, size, client):
+        path = os.path.join(self.directory, str(transfer_id))
+        file = open(os.open(path + ".data", os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600), "r+b", buffering=0)
+        created = time.time()
+        with open(path + ".json", "w") as f:
+            json.dump({"id": transfer_id, "name": name, "size": size, "owner": client.nickname,
+                       "room": client.room, "created": created}, f)
+        transfer = self.transfers[transfer_id] = Transfer(transfer_id, name, size, client.nickname, client.room,
+                                                          file, created)
+        return transfer
+
+    # deletes a transfer's files; downloads already running finish from the open file
+    def remove(self, transfer):
+        del self.transfers[transfer.id]
+        waiting, transfer.waiting = transfer.waiting, set()
+        for client in waiting:
+            client.downloads = [download for download in client.downloads if download.transfer is not transfer]
+        path = os.path.join(self.directory, str(transfer.id))
+        for suffix in (".json", ".data"):
+            try:
+                os.unlink(path + suffix)
+            except FileNotFoundError:
+                pass
+
+    def expire(self):
+        deadline = time.time() - self.ttl
+        for transfer in [transfer for transfer in self.transfers.values() if transfer.created < deadline]:
+            self.remove(transfer)
+
+    # makes the spool take a file of size bytes, counting every transfer at its full size; uploads
+    # still running are never removed, only expired or finished files, and none if that wouldn't do
+    def make_room(self, size):
+        self.expire()
+        used = sum(transfer.size for transfer in self.transfers.values())
+        finished = [transfer for transfer in self.transfers.values() if transfer.received == transfer.size]
+        if used - sum(transfer.size for transfer in finished) + size > self.spool_bytes:
+            return False
+        for transfer in finished:
+            if used + size <= self.spool_bytes:
+                break
+            self.remove(transfer)
+            used -= transfer.size
+        return True
+
+    # writes the next chunk of an upload without holding the lock, the server reads no further from the
+    # uploader until it is on disk
+    def chunk(self, client, frame):
+        transfer_id, offset, data = protocol.decode_chunk(protocol.payload_of(frame))
+        with self.lock:
+            transfer = self.transfers.get(transfer_id)
+            if transfer is None or transfer.owner != client.nickname:
+                raise protocol.ProtocolError("chunk of unknown transfer {}".format(transfer_id))
+            if offset != transfer.received or offset + len(data) > transfer.size:
+                raise protocol.ProtocolError("chunk at {} of transfer {} expected at {}".format(
+                    offset, transfer_id, transfer.received))
+        self.server.offload(client, lambda written: self.stored(client, transfer, offset + len(data)),
+                            write_chunk, transfer, offset, bytes(data))
+
+    # counts a written chunk and wakes up the downloads that were waiting for it
+    def stored(self, client, transfer, received):
+        with self.lock:
+            transfer.received = received
+            waiting, transfer.waiting = transfer.waiting, set()
+        if transfer.received == transfer.size:
+            self.server.display("{} finished uploading {}".format(client.nickname, transfer.name))
+        for other in waiting:
+            self.pump(other)
+
+    # /get <id> [<offset>]: sends a client a file, or the rest of it from offset
+    def get(self, client, arg):
+        try:
+            words = arg.split()
+            transfer_id = int(words[0])
+            offset = int(words[1]) if len(words) > 1 else 0
+        except (IndexError, ValueError):
+            self.server.notice(client, "Usage: /get <id> [<offset>]")
+            return
+        with self.lock:
+            self.expire()
+            transfer = self.transfers.get(transfer_id)
+            if transfer is not None:
+                client.downloads = [download for download in client.downloads if download.transfer is not transfer]
+        if transfer is None or transfer.room != client.room:
+            self.server.notice(client, "No file {} in #{}".format(transfer_id, client.room))
+            return
+        if not 0 <= offset <= transfer.size:
+            self.server.notice(client, "{} has only {} bytes".format(transfer.name, transfer.size))
+            return
+        # sending may block on a full queue and drop the client, which takes other locks, so not under ours;
+        # the old download is gone already, none of its chunks can follow the new OFFER
+        self.server.send(client, protocol.encode_offer(transfer.id, transfer.name, transfer.size,
+                                                       offset=offset, **{"from": transfer.owner}))
+        if offset < transfer.size:
+            with self.lock:
+                client.downloads.append(Download(transfer, offset))
+        self.pump(client)
+
+    # /files: the latest files shared in the client's room
+    def list(self, client):
+        with self.lock:
+            self.expire()
+            transfers = [transfer for transfer in self.transfers.values() if transfer.room == client.room]
+        if not transfers:
+            self.server.notice(client, "No files in #{}".format(client.room))
+            return
+        lines = [transfer.describe() for transfer in transfers[-LISTED:]]
+        self.server.notice(client, "Files in #{}:\n".format(client.room) + "\n".join(lines))
+
+    # queues file chunks for a client while it has room for them, taking turns between its downloads;
+    # a download that caught up with its upload waits until the next chunk of it arrives
+    def pump(self, client):
+        with self.lock:
+            downloads = collections.deque(client.downloads)
+            stalled = 0
+            while downloads and stalled < len(downloads) and client.bulk_room():
+                download = downloads[0]
+                transfer = download.transfer
+                size = min(protocol.CHUNK_SIZE, transfer.received - download.offset)
+                if size <= 0:
+                    transfer.waiting.add(client)
+                    downloads.rotate(-1)
+                    stalled += 1
+                    continue
+                stalled = 0
+                client.send_chunk(transfer, download.offset, size)
+                download.offset += size
+                if download.offset >= transfer.size:
+                    downloads.popleft()
+                else:
+                    downloads.rotate(-1)
+            client.downloads = list(downloads)
+
+    # drops what a client that went away was downloading, its uploads stay for it to resume
+    def forget(self, client):
+        with self.lock:
+            for download in client.downloads:
+                download.transfer.waiting.discard(client)
+            client.downloads = []
+
+    def stats(self):
+        with self.lock:
+            uploading = sum(1 for transfer in self.transfers.values() if transfer.received < transfer.size)
+            return {"files": len(self.transfers), "uploading": uploading,
+                    "bytes": sum(transfer.received for transfer in self.transfers.values())}
@@ -1,26 +1,40 @@
+import argparse
+import itertools
 import threading
 import socket
+import tkinter
+from tkinter import filedialog
 import customtkinter
-from PIL import Image
+from PIL import Image, ImageTk
 import queue
+import protocol
+import server
+from client import QUEUE_LIMIT, take_pending
+from scrollback import Scrollback
+from thumbnails import ThumbnailCache, is_image
+from transfers import FileTransfers
+
+# how often the main loop moves queued lines into the chatbox, in milliseconds
+DISPLAY_INTERVAL = 50
+# most lines inserted in one go, so a flood can't stall the main loop
+DISPLAY_BATCH = 2000
+# lines the chatbox keeps, older ones are trimmed to disk in chunks and paged back in when scrolled to the top
+SCROLLBACK = 5000
+SCROLLBACK_CHUNK = 500
+# image thumbnails kept in memory, the least recently shown ones are dropped and made again when scrolled back to
+THUMBNAILS = 64
+# images shared in the room up to this size are downloaded right away to show their thumbnail
+AUTO_FETCH_BYTES = 8 * 1024 * 1024
 
 
 class Server:
-    def __init__(self, host, port, peers):
+    def __init__(self, host, port, peers, engine, files=None):
         # attributes
-        self.host = host
-        self.port = port
-        self.peers = peers
-        self.clients = []
-        self.nicknames = []
         self.message_queue = queue.Queue()
         self.app = app
 
-        # start server
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(self.peers)
-        self.app.display_message("Listening at {}".format(self.server_socket.getsockname()))
+        # start server, files shared in the chat are only taken if a spool directory was given
+        self.engine = server.create_server(engine, host, port, peers, display=self.app.display_message, files=files)
 
         # start write thread
         write_thread = threading.Thread(target=self.write)
@@ -28,54 +42,21 @@ class Server:
         write_thread.start()
 
         # start main thread
-        main_thread = threading.Thread(target=self.main, args=(self.server_socket,))
+        main_thread = threading.Thread(target=self.engine.run)
         main_thread.daemon = True
         main_thread.start()
 
-    # broadcast a message to all connected clients and server itself
-    def broadcast(self, msg):
-        for client in self.clients:
-            client.sendall(msg.encode())
-        self.app.display_message(msg)
-
-    # method for handling a single client
-    def handle(self, client):
-        while True:
-            try:
-                msg = client.recv(1024).decode()
-                self.broadcast(msg)
-            except socket.error:
-                print("Error!")
-                break
-
     # write function for server
     def write(self):
         while True:
             msg = self.message_queue.get()
             formatted_msg = "{}: {}".format("Server", msg)
-            self.broadcast(formatted_msg)
+            self.engine.announce(formatted_msg)
 
     # adds a message to the queue
     def add_to_queue(self, msg):
         self.message_queue.put(msg)
 
-    # main thread, waits for connections and starts single threads for every client
-    def main(self, soc):
-        while True:
-            client, addr = soc.accept()
-
-            client.sendall("NICKNAME".encode())
-            nickname = client.recv(1024).decode()
-
-            self.clients.append(client)
-            self.nicknames.append(nickname)
-
-            self.broadcast("{} connected to the chat!".format(nickname))
-
-            handle_thread = threading.Thread(target=self.handle, args=(client,))
-            handle_thread.daemon = True
-            handle_thread.start()
-
 
 class Client:
     def __init__(self, host, port, nickname):
@@ -83,8 +64,16 @@ class Client:
         self.host = host
         self.port = port
         self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # the receive thread answers heartbeats while the write thread sends, one frame at a time
+        self.send_lock = threading.Lock()
+        self.last_seq = 0
+        # frames from this size on are sent compressed, 0 until the server offers compression
+        self.compress_min = 0
+        # set once the handshake went out, nothing else may be sent before it
+        self.joined = threading.Event()
         self.nickname = nickname
-        self.message_queue = queue.Queue()
+        self.message_queue = queue.Queue(QUEUE_LIMIT)
+        self.files = FileTransfers(self.app.display_message)
         try:
             self.client_socket.connect((host, port))
             self.app.display_message("Successfully connected to {}".format(self.client_socket.getpeername()))
@@ -100,31 +89,95 @@ class Client:
 
     # waits for a message from the server and displays it
     def receive(self):
+        decoder = protocol.FrameDecoder()
         while True:
             try:
-                msg = self.client_socket.recv(1024).decode()
-                if msg == "NICKNAME":
-                    self.client_socket.sendall(self.nickname.encode())
-                    continue
-                self.app.display_message(msg)
-            except socket.error:
+                data = self.client_socket.recv(protocol.READ_SIZE)
+                if not data:
+                    break
+                for kind, payload in protocol.expand(decoder.feed(data)):
+                    if kind == protocol.NICKNAME:
+                        self.compress_min = protocol.compression_offer(payload)
+                        compression = protocol.COMPRESSION if self.compress_min else None
+                        self.send(protocol.hello(self.nickname, since=self.last_seq, compression=compression))
+                        for frame in self.files.reoffer():
+                            self.send(frame)
+                        self.joined.set()
+                    elif kind == protocol.PING:
+                        self.send(protocol.pong())
+                    elif kind == protocol.TEXT:
+                        self.app.display_message(payload.decode(errors="replace"))
+                    elif kind == protocol.OFFER:
+                        self.offered(payload)
+                    elif kind == protocol.RESUME:
+                        self.files.resumed(payload)
+                        self.wake_writer()
+                    elif kind == protocol.CHUNK:
+                        path = self.files.received(payload)
+                        if path is not None and is_image(path):
+                            self.app.display_image("Saved {}".format(path), path)
+                        elif path is not None:
+                            self.app.display_message("Saved {}".format(path))
+                    elif kind in (protocol.MESSAGE, protocol.HISTORY):
+                        for seq, text in protocol.decode_messages(kind, payload):
+                            self.last_seq = max(self.last_seq, seq)
+                            self.app.display_message(text.decode(errors="replace"))
+                    elif kind == protocol.ERROR:
+                        self.app.display_message("Connection rejected: {}".format(payload.decode(errors="replace")))
+            except (socket.error, protocol.ProtocolError):
                 self.app.display_message("An error occurred...")
                 break
 
-    # write function for client
+    # fetches images shared in the room right away, so their thumbnails can be shown
+    def offered(self, payload):
+        offer = self.files.offered(payload)
+        if ("offset" not in offer and offer.get("from") != self.nickname and is_image(offer["name"])
+                and offer["size"] <= AUTO_FETCH_BYTES):
+            self.add_to_queue("/get {}".format(offer["id"]), block=False)
+
+    # sends everything queued since the last write as one batch of frames, then a chunk of a file being
+    # uploaded; chat never waits for more than one chunk
     def write(self):
+        self.joined.wait()
         while True:
-            msg = self.message_queue.get()
-            formatted_msg = "{}: {}".format(self.nickname, msg)
-            self.client_socket.sendall(formatted_msg.encode())
-
-    # adds a message to the queue
-    def add_to_queue(self, msg):
-        self.message_queue.put(msg)
+            lines = take_pending(self.message_queue, block=not self.files.sending())
+            data = b"".join(self.encode_line(line) for line in lines if line is not None)
+            if data:
+                self.send(data)
+            chunk = self.files.next_chunk()
+            if chunk is not None:
+                self.send(chunk, compress=False)
+
+    def encode_line(self, line):
+        frame = self.files.command(line)
+        return frame if frame is not None else protocol.encode_input(self.nickname, line)
+
+    # lets a write thread waiting for lines know an upload can go on
+    def wake_writer(self):
+        try:
+            self.message_queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    # sends a whole frame, the lock keeps heartbeat answers from landing inside a chat frame
+    def send(self, data, compress=True):
+        if compress and self.compress_min and len(data) >= self.compress_min:
+            data = protocol.compress(data)
+        with self.send_lock:
+            self.client_socket.sendall(data)
+
+    # adds a message to the queue; with block=False, or once timeout runs out, a full queue
+    # leaves the message out and returns False so the caller can slow down
+    def add_to_queue(self, msg, block=True, timeout=None):
+        try:
+            self.message_queue.put(msg, block, timeout)
+        except queue.Full:
+            return False
+        return True
 
 
 class App(customtkinter.CTk, threading.Thread):
-    def __init__(self):
+    def __init__(self, scrollback=SCROLLBACK, scrollback_file=None, files=None):
         super().__init__()
         # configuration for main window
         self.title("Chatroom")
@@ -145,8 +198,23 @@ class App(customtkinter.CTk, threading.Thread):
                                                  corner_radius=0)
         self.main_frame.grid(row=0, column=0, sticky="nswe")
 
+        # lines waiting for the chatbox, network threads put here and only the main loop touches widgets
+        self.display_queue = queue.Queue()
+        self.chatbox = None
+        # 0 keeps every line in the chatbox
+        self.scrollback_limit = scrollback
+        self.scrollback = Scrollback(scrollback_file)
+        # lines showing a downloaded image, text tag -> [path, label with the thumbnail or None];
+        # a thumbnail is only made once its line is scrolled into view
+        self.image_slots = {}
+        self.image_tags = itertools.count()
+        self.thumbnails = ThumbnailCache(THUMBNAILS, evicted=self.thumbnail_evicted)
+        # spool directory of the hosted server, file sharing is off without one
+        self.file_spool = files
+
         # display menu frame
         self.menu_frame()
+        self.after(DISPLAY_INTERVAL, self.pump_messages)
 
     # handles the menu frame
     def menu_frame(self):
@@ -249,6 +317,15 @@ class App(customtkinter.CTk, threading.Thread):
                                                   text_color="#ffffff",
                                                   fg_color="#202020",
                                                   border_color="#8A2BE2")
+        engine_label = customtkinter.CTkLabel(self.main_frame,
+                                              text="Server Engine:",
+                                              text_color="#ffffff",
+                                              font=("Arial", 20))
+        self.engine_menu = customtkinter.CTkOptionMenu(self.main_frame,
+                                                       values=list(server.ENGINES),
+                                                       fg_color="#8A2BE2",
+                                                       button_color="#8A2BE2",
+                                                       button_hover_color="#9400D3")
         if config == "SERVER":
             # build frame with server-preset
             title_label.grid(row=0, column=0, columnspan=2)
@@ -258,6 +335,8 @@ class App(customtkinter.CTk, threading.Thread):
             self.ip_entry.grid(row=1, column=1)
             self.port_entry.grid(row=2, column=1)
             self.peers_entry.grid(row=3, column=1)
+            engine_label.grid(row=4, column=0)
+            self.engine_menu.grid(row=4, column=1)
             start_button.grid(row=5, column=1)
             abort_button.grid(row=5, column=0)
 
@@ -295,9 +374,10 @@ class App(customtkinter.CTk, threading.Thread):
         self.config = config
         # initializes variables containing key values
         if self.config == "CLIENT":
-            self.nickname = self.nickname_entry.get()
+            self.nickname = self.nickname_entry.get().strip()
         else:
             self.peers = int(self.peers_entry.get())
+            self.engine = self.engine_menu.get()
         self.ip = self.ip_entry.get()
         self.port = int(self.port_entry.get())
 
@@ -378,12 +458,37 @@ class App(customtkinter.CTk, threading.Thread):
             server_thread.daemon = True
             server_thread.start()
         else:
+            # room picker, pick a known room or type a new name and press enter
+            self.room_box = customtkinter.CTkComboBox(head_frame,
+                                                      width=120,
+                                                      values=[protocol.DEFAULT_ROOM],
+                                                      text_color="#ffffff",
+                                                      fg_color="#202020",
+                                                      border_color="#8A2BE2",
+                                                      button_color="#8A2BE2",
+                                                      button_hover_color="#9400D3",
+                                                      command=self.join_room)
+            self.room_box.set(protocol.DEFAULT_ROOM)
+            self.room_box.bind("<Return>", lambda event: self.join_room(self.room_box.get()))
+            file_button = customtkinter.CTkButton(head_frame,
+                                                  width=40,
+                                                  text="File",
+                                                  text_color="#202020",
+                                                  font=("Arial", 20),
+                                                  fg_color="#8A2BE2",
+                                                  hover_color="#9400D3",
+                                                  command=self.send_file)
+
             # build client based chat-frame
+            head_frame.grid_columnconfigure(2, weight=1)
+            head_frame.grid_columnconfigure(3, weight=1)
             head_frame.grid(row=0, column=0, columnspan=2, sticky="nwe")
             self.chatbox.grid(row=1, column=0, columnspan=2, pady=(0, 10), padx=(20, 20), sticky="nswe")
             self.text_entry.grid(row=2, column=0, padx=(20, 0), pady=(0, 10), sticky="nsw")
             send_button.grid(row=2, column=1, padx=(0, 20), pady=(0, 10), sticky="nse")
-            abort_button.grid(row=0, column=1, padx=(0, 20), pady=(10, 0), sticky="nse")
+            self.room_box.grid(row=0, column=1, pady=(10, 0))
+            file_button.grid(row=0, column=2, pady=(10, 0))
+            abort_button.grid(row=0, column=3, padx=(0, 20), pady=(10, 0), sticky="nse")
             title_label.grid(row=0, column=0, padx=(20, 0), pady=(10, 0), sticky="nsw")
 
             # configure text
@@ -402,19 +507,137 @@ class App(customtkinter.CTk, threading.Thread):
         for elem in widget.winfo_children():
             elem.destroy()
 
-    # displays given message in the textbox
+    # queues a message for the textbox, safe to call from any thread
     def display_message(self, msg):
+        self.display_queue.put(msg)
+
+    # runs on the main loop: inserts every queued message at once and scrolls once per batch
+    def pump_messages(self):
+        if self.chatbox is not None and self.chatbox.winfo_exists():
+            lines = []
+            try:
+                while len(lines) < DISPLAY_BATCH:
+                    lines.append(self.display_queue.get_nowait())
+            except queue.Empty:
+                pass
+            # only follow new lines if the view is at the bottom, so reading older ones isn't interrupted
+            top, bottom = self.chatbox.yview()
+            following = bottom >= 1.0
+            if lines:
+                self.chatbox.configure(state="normal")
+                self.insert_lines(lines)
+                self.trim_scrollback(following)
+                if following:
+                    self.chatbox.yview(customtkinter.END)
+                self.chatbox.configure(state="disabled")
+            elif top <= 0.0 and not following and len(self.scrollback):
+                self.page_scrollback()
+            if self.image_slots:
+                self.show_thumbnails()
+        self.after(DISPLAY_INTERVAL, self.pump_messages)
+
+    # queues a line that gets the thumbnail of an image file in front of it, safe to call from any thread
+    def display_image(self, caption, path):
+        self.display_queue.put((caption, path))
+
+    # appends queued lines in as few inserts as possible, each image line gets a tag of its own
+    def insert_lines(self, lines):
+        text = []
+        for line in lines:
+            if not isinstance(line, tuple):
+                text.append(line)
+                continue
+            if text:
+                self.chatbox.insert(customtkinter.END, "\n".join(text) + "\n")
+                text = []
+            caption, path = line
+            tag = "image{}".format(next(self.image_tags))
+            self.chatbox.insert(customtkinter.END, caption + "\n", tag)
+            self.image_slots[tag] = [path, None]
+        if text:
+            self.chatbox.insert(customtkinter.END, "\n".join(text) + "\n")
+
+    # puts thumbnails in front of the image lines in view, forgets the lines trimmed to the scrollback
+    def show_thumbnails(self):
+        self.thumbnails.collect(ImageTk.PhotoImage)
+        first = int(self.chatbox.index("@0,0").split(".")[0])
+        last = int(self.chatbox.index("@0,{}".format(self.chatbox.winfo_height())).split(".")[0])
+        for tag, slot in list(self.image_slots.items()):
+            ranges = self.chatbox.tag_ranges(tag)
+            if not ranges:
+                del self.image_slots[tag]
+                continue
+            line = int(str(ranges[0]).split(".")[0])
+            if slot[1] is not None or not first <= line <= last:
+                continue
+            thumbnail = self.thumbnails.get(slot[0])
+            if thumbnail is None:
+                continue
+            slot[1] = tkinter.Label(self.chatbox, image=thumbnail, borderwidth=0, background="#202020")
+            self.chatbox.configure(state="normal")
+            self.chatbox.window_create(ranges[0], window=slot[1])
+            self.chatbox.configure(state="disabled")
+
+    # takes a dropped thumbnail out of the lines showing it, it is made again if they come back into view
+    def thumbnail_evicted(self, path):
         self.chatbox.configure(state="normal")
-        self.chatbox.insert(customtkinter.END, msg + "\n")
-        self.chatbox.yview(customtkinter.END)
+        for slot in self.image_slots.values():
+            if slot[0] == path and slot[1] is not None:
+                self.chatbox.delete(str(slot[1]))
+                slot[1].destroy()
+                slot[1] = None
         self.chatbox.configure(state="disabled")
 
+    # number of lines in the chatbox
+    def chatbox_lines(self):
+        return int(self.chatbox.index("end-1c").split(".")[0]) - 1
+
+    # moves the oldest lines to the scrollback store in whole chunks once the chatbox is over its limit,
+    # while the user reads older lines the chatbox may grow to twice the limit before it is trimmed anyway
+    def trim_scrollback(self, following):
+        if not self.scrollback_limit:
+            return
+        excess = self.chatbox_lines() - self.scrollback_limit
+        if excess <= 0 or not following and excess < self.scrollback_limit:
+            return
+        cut = -(-excess // SCROLLBACK_CHUNK) * SCROLLBACK_CHUNK
+        end = "{}.0".format(cut + 1)
+        self.scrollback.push(self.chatbox.get("1.0", end))
+        self.chatbox.delete("1.0", end)
+
+    # puts the most recently trimmed chunk back on top and keeps the view on the line it was showing
+    def page_scrollback(self):
+        text = self.scrollback.pop()
+        self.chatbox.configure(state="normal")
+        self.chatbox.insert("1.0", text)
+        self.chatbox.configure(state="disabled")
+        self.chatbox.yview("{}.0".format(text.count("\n") + 1))
+
     # TODO: Check if methods below can be optimized
     # method for sending a message from a client
     def send_client_message(self):
         msg = self.text_entry.get()
-        if msg:
-            self.client.add_to_queue(msg)
+        # the main loop must not wait for the network, a full queue is reported instead
+        if msg and not self.client.add_to_queue(msg, block=False):
+            self.display_message("Sending too fast, message not sent")
+
+    # picks a file and uploads it to the room
+    def send_file(self):
+        path = filedialog.askopenfilename(parent=self)
+        if path and not self.client.add_to_queue("/send " + path, block=False):
+            self.display_message("Sending too fast, file not sent")
+
+    # switches the client to another room
+    def join_room(self, room):
+        room = room.strip()
+        if protocol.room_error(room):
+            self.display_message(protocol.room_error(room))
+            return
+        rooms = self.room_box.cget("values")
+        if room not in rooms:
+            self.room_box.configure(values=list(rooms) + [room])
+        if not self.client.add_to_queue("/join " + room, block=False):
+            self.display_message("Sending too fast, message not sent")
 
     # method for sending a message from the server
     def send_server_message(self):
@@ -424,7 +647,7 @@ class App(customtkinter.CTk, threading.Thread):
 
     # creates an instance of Server class
     def start_server(self):
-        self.server = Server(self.ip, self.port, self.peers)
+        self.server = Server(self.ip, self.port, self.peers, self.engine, self.file_spool)
 
     # creates an instance of Client class
     def start_client(self):
@@ -433,5 +656,12 @@ class App(customtkinter.CTk, threading.Thread):
 
 # runs the mainloop
 if __name__ == "__main__":
-    app = App()
+    parser = argparse.ArgumentParser(description="Chatroom GUI")
+    parser.add_argument("--scrollback", type=int, default=SCROLLBACK,
+                        help="lines kept in the chat window, older ones are paged in from disk (0 keeps all)")
+    parser.add_argument("--scrollback-file", help="file for trimmed lines instead of an anonymous temporary file")
+    parser.add_argument("--files", metavar="DIR",
+                        help="let clients of a hosted server share files, spooled to this directory")
+    args = parser.parse_args()
+    app = App(args.scrollback, args.scrollback_file, args.files)
     app.mainloop()
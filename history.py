@@ -0,0 +1,60 @@
+import collections
+import itertools
+import threading
+
+import protocol
+
+
+# ring buffer of recent sequenced messages, bounded by count and by bytes
+class History:
+    def __init__(self, max_messages=10000, max_bytes=4 * 1024 * 1024):
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        # (seq, room, MESSAGE frame), seq increases by one from entry to entry
+        self.entries = collections.deque()
+        self.bytes = 0
+        self.seq = 0
+        # held while a message is numbered and queued for its recipients, so every client gets messages in order
+        # and a joining client gets each one either in its replay or live, never both or neither
+        self.lock = threading.RLock()
+
+    # stamps a text with the next sequence number (or the one the worker bus assigned) and keeps it,
+    # returns the MESSAGE frame to send
+    def add(self, room, text, seq=None):
+        with self.lock:
+            if seq is None:
+                seq = self.seq + 1
+            elif seq != self.seq + 1:
+                # numbering restarted or skipped ahead, older entries can't be addressed anymore
+                self.clear()
+            self.seq = seq
+            frame = protocol.encode_message(seq, text)
+            if self.max_messages and self.max_bytes:
+                self.entries.append((seq, room, frame))
+                self.bytes += len(frame)
+                while len(self.entries) > self.max_messages or self.bytes > self.max_bytes:
+                    self.bytes -= len(self.entries.popleft()[2])
+            return frame
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
+    # frames after the given sequence number that were sent to the room or to everyone
+    def since(self, seq, room):
+        with self.lock:
+            if not self.entries:
+                return []
+            start = max(0, seq - self.entries[0][0] + 1)
+            return [frame for _, entry_room, frame in itertools.islice(self.entries, start, None)
+                    if entry_room is None or entry_room == room]
+
+    # the frame of one message, None if it is no longer kept
+    def get(self, seq):
+        with self.lock:
+            if self.entries and 0 <= seq - self.entries[0][0] < len(self.entries):
+                return self.entries[seq - self.entries[0][0]][2]
+            return None
+
+    def stats(self):
+        return {"seq": self.seq, "messages": len(self.entries), "bytes": self.bytes}
@@ -0,0 +1,69 @@
+import threading
+import time
+
+import protocol
+
+
+# hashed timer wheel: one slot per tick, scheduling and expiring a timer are O(1) however many are pending;
+# delays longer than the wheel come back early and are simply scheduled again
+class TimerWheel:
+    def __init__(self, tick, slots):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.position = 0
+        self.lock = threading.Lock()
+
+    # calls item up after at least delay seconds, at the next tick for delays shorter than one
+    def schedule(self, item, delay):
+        ticks = min(len(self.slots) - 1, max(1, -int(-delay // self.tick)))
+        with self.lock:
+            self.slots[(self.position + ticks) % len(self.slots)].add(item)
+
+    # moves on by one tick and returns the items that are due
+    def advance(self):
+        with self.lock:
+            self.position = (self.position + 1) % len(self.slots)
+            due = self.slots[self.position]
+            self.slots[self.position] = set()
+        return due
+
+
+# pings connections that have been quiet for interval seconds and drops the ones that
+# don't answer within timeout; reads only stamp client.last_seen, the wheel does the rest
+class Heartbeat:
+    def __init__(self, server, interval, timeout):
+        self.server = server
+        self.interval = interval
+        self.timeout = timeout
+        tick = max(0.05, min(interval, timeout) / 4)
+        self.wheel = TimerWheel(tick, int(max(interval, timeout) / tick) + 2)
+        self.ping = protocol.encode_frame(protocol.PING)
+
+    # starts watching a freshly accepted connection
+    def watch(self, client):
+        client.last_seen = time.monotonic()
+        client.pinged_at = None
+        self.wheel.schedule(client, self.interval)
+
+    # looks at every connection whose timer ran out
+    def tick(self):
+        now = time.monotonic()
+        for client in self.wheel.advance():
+            self.expire(client, now)
+
+    def expire(self, client, now):
+        if client.outbox.closed:
+            return
+        if client.pinged_at is not None and client.last_seen < client.pinged_at:
+            if self.server.metrics is not None:
+                self.server.metrics.inc("connections_reaped")
+            self.server.disconnect(client, "no answer to heartbeat for {}s".format(self.timeout))
+            return
+        idle = now - client.last_seen
+        if idle < self.interval:
+            client.pinged_at = None
+            self.wheel.schedule(client, self.interval - idle)
+        else:
+            client.pinged_at = now
+            self.server.send(client, self.ping)
+            self.wheel.schedule(client, self.timeout)
@@ -0,0 +1,206 @@
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+from bot import LatencyBot, connect
+from server import ENGINES
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+
+# reads resident memory, thread count and CPU time of a process from /proc
+def process_stats(pid):
+    stats = {}
+    try:
+        with open("/proc/{}/stat".format(pid)) as stat:
+            fields = stat.read().rsplit(")", 1)[1].split()
+        stats["cpu_seconds"] = round((int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK"), 2)
+        with open("/proc/{}/status".format(pid)) as status:
+            for line in status:
+                key, _, value = line.partition(":")
+                if key == "VmRSS":
+                    stats["rss_kb"] = int(value.split()[0])
+                elif key == "Threads":
+                    stats["threads"] = int(value)
+    except OSError:
+        pass
+    return stats
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+# latency percentiles in milliseconds
+def latency_summary(latencies):
+    summary = {}
+    for name, fraction in (("p50", 0.50), ("p90", 0.90), ("p99", 0.99), ("max", 1.0)):
+        value = percentile(latencies, fraction)
+        summary["latency_{}_ms".format(name)] = None if value is None else round(value * 1000, 3)
+    return summary
+
+
+# lets a process open as many sockets as the hard limit allows
+def raise_fd_limit():
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+# starts a server in its own process, for measuring it from the outside; flood protection is off
+# so the load is not throttled, extra arguments can turn it back on
+def spawn_server(engine, host, port, peers, extra=()):
+    cmd = [sys.executable, "server.py", "--engine", engine, "--relay", "--rate-messages", "0", "--rate-bytes", "0",
+           "--host", host, "--port", str(port), "--peers", str(peers)] + list(extra)
+    return subprocess.Popen(cmd, cwd=ROOT, stdout=subprocess.DEVNULL)
+
+
+# opens the simulated users, a limited number of handshakes at a time
+async def connect_users(args):
+    semaphore = asyncio.Semaphore(args.concurrency)
+    failures = []
+
+    async def open_user(i):
+        room = "room{}".format(i % args.rooms) if args.rooms > 1 else None
+        async with semaphore:
+            try:
+                return await connect(args.host, args.port, "user{}".format(i), room, factory=LatencyBot,
+                                     retry_for=10.0 if i == 0 else 0.0)
+            except (OSError, ConnectionError) as e:
+                failures.append(str(e))
+                return None
+
+    first = await open_user(0)
+    start = time.perf_counter()
+    rest = await asyncio.gather(*(open_user(i) for i in range(1, args.users)))
+    elapsed = time.perf_counter() - start
+    bots = [bot for bot in [first] + rest if bot is not None]
+    return bots, elapsed, failures
+
+
+# every sender sends stamped messages at its rate for the duration
+async def send_load(senders, args):
+    interval = 1.0 / args.rate
+    end = time.monotonic() + args.duration
+    counts = []
+
+    async def run_sender(bot, offset):
+        sent = 0
+        await asyncio.sleep(offset)
+        next_send = time.monotonic()
+        while next_send < end:
+            bot.say_stamped(args.size)
+            sent += 1
+            next_send += interval
+            await asyncio.sleep(max(0.0, next_send - time.monotonic()))
+        counts.append((bot, sent))
+
+    # spread the senders over one interval so they don't all fire on the same tick
+    await asyncio.gather(*(run_sender(bot, interval * i / len(senders)) for i, bot in enumerate(senders)))
+    return counts
+
+
+async def run_load(args, pid=None):
+    bots, connect_seconds, failures = await connect_users(args)
+    if not bots:
+        return {"users": 0, "connect_failures": len(failures), "errors": failures[:5]}
+
+    # let the join announcements settle before measuring
+    await asyncio.sleep(args.settle)
+    for bot in bots:
+        del bot.latencies[:]
+        bot.received = 0
+    before = process_stats(pid) if pid else {}
+
+    room_sizes = {}
+    for bot in bots:
+        room_sizes[bot.room] = room_sizes.get(bot.room, 0) + 1
+    senders = bots[:args.senders] if args.senders else bots
+    start = time.perf_counter()
+    counts = await send_load(senders, args)
+    send_seconds = time.perf_counter() - start
+
+    sent = sum(count for _, count in counts)
+    expected = sum(count * room_sizes[bot.room] for bot, count in counts)
+    deadline = time.monotonic() + args.drain
+    while sum(bot.received for bot in bots) < expected and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    after = process_stats(pid) if pid else {}
+
+    delivered = sum(bot.received for bot in bots)
+    latencies = [latency for bot in bots for latency in bot.latencies]
+    for bot in bots:
+        bot.close()
+
+    result = {
+        "users": len(bots),
+        "connect_failures": len(failures),
+        "connect_seconds": round(connect_seconds, 4),
+        "connects_per_second": round((len(bots) - 1) / connect_seconds, 1) if connect_seconds else None,
+        "senders": len(senders),
+        "sent": sent,
+        "send_rate": round(sent / send_seconds, 1),
+        "expected_deliveries": expected,
+        "delivered": delivered,
+        "deliveries_per_second": round(delivered / elapsed, 1),
+    }
+    result.update(latency_summary(latencies))
+    if after:
+        result["server_rss_kb"] = after.get("rss_kb")
+        result["server_threads"] = after.get("threads")
+        result["server_cpu_seconds"] = round(after.get("cpu_seconds", 0) - before.get("cpu_seconds", 0), 2)
+    return result
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Drive simulated chat users against a server and report JSON")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--senders", type=int, default=0, help="users that send, 0 for all of them")
+    parser.add_argument("--rooms", type=int, default=1, help="spread the users over this many rooms")
+    parser.add_argument("--rate", type=float, default=1.0, help="messages per second per sender")
+    parser.add_argument("--size", type=int, default=64, help="message size in bytes")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds of sending")
+    parser.add_argument("--concurrency", type=int, default=100, help="handshakes in flight while connecting")
+    parser.add_argument("--settle", type=float, default=1.0, help="seconds to wait between connecting and sending")
+    parser.add_argument("--drain", type=float, default=10.0, help="seconds to wait for deliveries after sending")
+    parser.add_argument("--server-pid", type=int, help="report RSS and CPU of this server process")
+    parser.add_argument("--spawn", choices=ENGINES, help="start a server with this engine instead of using a running one")
+    parser.add_argument("--server-arg", action="append", default=[], help="extra argument for the spawned server")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    raise_fd_limit()
+    proc = None
+    pid = args.server_pid
+    if args.spawn:
+        proc = spawn_server(args.spawn, args.host, args.port, args.users, args.server_arg)
+        pid = proc.pid
+    try:
+        result = asyncio.run(run_load(args, pid))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+    result["engine"] = args.spawn
+    result["timestamp"] = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+    print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
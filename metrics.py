@@ -0,0 +1,114 @@
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# histogram with power-of-two buckets, cheap enough to update on every broadcast
+class Histogram:
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        bucket = 1
+        while bucket < value:
+            bucket <<= 1
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    # upper bucket bound below which the given fraction of observations fall
+    def quantile(self, fraction):
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= fraction * self.count:
+                return bucket
+        return 0
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean": round(self.total / self.count, 2) if self.count else 0,
+            "p50": self.quantile(0.50),
+            "p99": self.quantile(0.99),
+            "max": round(self.max, 2),
+            "buckets": {str(bucket): n for bucket, n in sorted(self.buckets.items())},
+        }
+
+
+# counters and histograms updated from the server's hot paths
+class Metrics:
+    def __init__(self):
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(value)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "uptime_seconds": round(time.time() - self.started, 1),
+                "counters": dict(self.counters),
+                "histograms": {name: histogram.snapshot() for name, histogram in self.histograms.items()},
+            }
+
+
+# answers GET /stats on a loopback port with the server's stats as JSON, and GET /connections with
+# the traffic and outbound queue of every connection
+def serve_stats(server, port, host="127.0.0.1"):
+    class StatsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path = self.path.rstrip("/")
+            if path in ("", "/stats"):
+                body = json.dumps(server.stats()).encode()
+            elif path == "/connections":
+                body = json.dumps(server.connection_stats()).encode()
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((host, port), StatsHandler)
+    httpd.daemon_threads = True
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return httpd
+
+
+# writes the server's stats as one JSON line every interval seconds
+def log_stats(server, interval, stream=None):
+    def run():
+        while True:
+            time.sleep(interval)
+            print(json.dumps(dict(server.stats(), time=time.time())), file=stream or sys.stderr, flush=True)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -0,0 +1,123 @@
+import collections
+import threading
+import time
+
+# what happens when a client's outbound queue is full
+DROP_OLDEST = "drop-oldest"  # discard the oldest queued frame to make room
+DISCONNECT = "disconnect"  # give up on the client
+BLOCK = "block"  # wait up to the timeout for the writer to catch up, then disconnect
+POLICIES = (DROP_OLDEST, DISCONNECT, BLOCK)
+
+
+class Overflow(Exception):
+    pass
+
+
+# bounded queue of frames waiting to be written to one client
+class Outbox:
+    def __init__(self, limit=1024, policy=DROP_OLDEST, timeout=5.0):
+        if policy not in POLICIES:
+            raise ValueError("unknown overflow policy {!r}".format(policy))
+        self.limit = limit
+        self.policy = policy
+        self.timeout = timeout
+        self.frames = collections.deque()
+        self.bytes = 0
+        # low-priority frames such as file chunks, never dropped; whoever queues them keeps the lane short
+        self.bulk = collections.deque()
+        self.cond = threading.Condition()
+        self.closed = False
+        self.high_water = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.frames)
+
+    # queues a frame, raises Overflow if the client should be disconnected;
+    # with wait=False a full BLOCK queue accepts the frame and returns False instead of waiting
+    def put(self, frame, wait=True):
+        with self.cond:
+            if self.closed:
+                return True
+            if len(self.frames) >= self.limit:
+                if self.policy == DROP_OLDEST:
+                    self.bytes -= len(self.frames.popleft())
+                    self.dropped += 1
+                elif self.policy == DISCONNECT:
+                    raise Overflow("outbound queue full ({} frames)".format(self.limit))
+                elif not wait:
+                    self.append(frame)
+                    return False
+                elif not self.cond.wait_for(self.has_room, self.timeout):
+                    raise Overflow("outbound queue stayed full for {}s".format(self.timeout))
+                elif self.closed:
+                    return True
+            self.append(frame)
+            return True
+
+    # waits for a BLOCK queue that took frames with wait=False to get below its limit again
+    def wait_for_room(self):
+        with self.cond:
+            if not self.cond.wait_for(self.has_room, self.timeout):
+                raise Overflow("outbound queue stayed full for {}s".format(self.timeout))
+
+    def append(self, frame):
+        self.frames.append(frame)
+        self.bytes += len(frame)
+        if len(self.frames) > self.high_water:
+            self.high_water = len(self.frames)
+        self.cond.notify_all()
+
+    # queues a low-priority frame, it leaves after the frames that are waiting when it is written
+    def put_bulk(self, frame):
+        with self.cond:
+            if not self.closed:
+                self.bulk.append(frame)
+                self.cond.notify_all()
+
+    def has_room(self):
+        return self.closed or len(self.frames) < self.limit
+
+    # waits for frames and removes everything queued plus one low-priority frame, returns an empty list once
+    # closed and drained; with a window it keeps collecting for that many seconds after the first frame,
+    # or until max_bytes are queued
+    def get_all(self, window=0.0, max_bytes=0):
+        with self.cond:
+            while not self.frames and not self.bulk and not self.closed:
+                self.cond.wait()
+            if self.bulk:
+                frames = self.drain()
+                frames.append(self.bulk.popleft())
+                return frames
+            if window > 0:
+                deadline = time.monotonic() + window
+                while not self.closed and not (max_bytes and self.bytes >= max_bytes):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+            return self.drain()
+
+    # removes and returns everything queued without waiting
+    def take_all(self):
+        with self.cond:
+            return self.drain()
+
+    def drain(self):
+        frames = list(self.frames)
+        self.frames.clear()
+        self.bytes = 0
+        self.cond.notify_all()
+        return frames
+
+    # wakes up the writer and anyone blocked in put
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.bulk.clear()
+            self.cond.notify_all()
+
+    # depth and high-water mark snapshot
+    def stats(self):
+        return {"depth": len(self.frames), "bytes": self.bytes, "high_water": self.high_water,
+                "dropped": self.dropped, "bulk": len(self.bulk)}
@@ -0,0 +1,425 @@
+import hashlib
+import hmac
+import json
+import struct
+import zlib
+
+# wire protocol version announced in the handshake
+VERSION = 1
+
+# every frame starts with the payload length and the frame type
+HEADER = struct.Struct("!IB")
+MAX_PAYLOAD = 16 * 1024 * 1024
+# frames from a peer that hasn't finished the handshake are buffered up to this size only
+MAX_HANDSHAKE = 4 * 1024
+READ_SIZE = 64 * 1024
+
+# frame types
+NICKNAME = 1  # server -> client, asks for the nickname; JSON {"version": ...}
+HELLO = 2  # client -> server, handshake reply; JSON {"version": ..., "nickname": ...}
+TEXT = 3  # chat message, UTF-8
+ERROR = 4  # server -> client, reason the connection is rejected, UTF-8
+COMMAND = 5  # client -> server, slash command such as "/join <room>", UTF-8
+ROUTE = 6  # between worker processes, a frame addressed to one room (or everyone)
+MESSAGE = 7  # server -> client, chat message with its sequence number; 8-byte seq + UTF-8
+HISTORY = 8  # server -> client, replayed MESSAGE frames packed back to back
+PING = 9  # either way, asks the other side to show it is still there; empty
+PONG = 10  # either way, answer to a PING; empty
+COMPRESSED = 11  # either way once negotiated, one or more whole frames deflated with DICTIONARY
+LINK = 12  # between federated servers, handshake; JSON {"version": ..., "nonce": ...} then {"node": ..., "proof": ...}
+RELAYED = 13  # between federated servers, a batch of chat messages; RELAYED_ENTRY records back to back
+OFFER = 14  # either way, a file: client -> server to upload (or resume) it, server -> client when one is shared
+# in the client's room or about to be sent to it; JSON {"id": ..., "name": ..., "size": ...}
+RESUME = 15  # server -> client, offset an upload carries on from; JSON {"id": ..., "offset": ...}
+CHUNK = 16  # either way, a piece of a file; CHUNK_HEADER followed by the bytes
+
+# compression the server offers in NICKNAME and a client may pick in HELLO: raw deflate with a preset dictionary,
+# every frame compressed on its own so a broadcast is compressed once and shared by all recipients
+COMPRESSION = "deflate"
+# frames from this size on are worth compressing
+COMPRESS_MIN = 512
+# most frames one COMPRESSED frame may carry
+MAX_COMPRESSED_FRAMES = 256
+# text chat messages are full of; deflate finds matches in it even in the first bytes of a short message,
+# the most common strings go last where they are cheapest to reference
+DICTIONARY = (
+    b"http://www. .org .net .io .html .png .jpg github.com/ youtube.com/watch?v= docs "
+    b"def class return import from self None True False if else for while in not and or "
+    b"would could should about there their they what when where which with this that have "
+    b"from just like know think really good yeah okay thanks please sorry maybe today tomorrow "
+    b"you are the and for but not all can her was one our out day get has him his how man new now "
+    b" joined # left # connected to the chat! left the chat! https://"
+)
+
+SEQ = struct.Struct("!Q")
+# one message relayed between servers: message id given by its origin, length of the path (names of the
+# nodes it passed, origin first, separated by spaces), length of the room name and of the text
+RELAYED_ENTRY = struct.Struct("!QHBI")
+MAX_NODE_NAME = 64
+# random bytes of the challenge each end of a link sends
+LINK_NONCE = 16
+# a file chunk starts with the transfer id and the chunk's offset in the file
+CHUNK_HEADER = struct.Struct("!QQ")
+CHUNK_SIZE = 64 * 1024
+MAX_FILE_NAME = 255
+
+# room every client starts in
+DEFAULT_ROOM = "lobby"
+MAX_ROOM_NAME = 32
+MAX_NICKNAME = 32
+
+
+class ProtocolError(Exception):
+    pass
+
+
+# builds a single frame
+def encode_frame(kind, payload=b""):
+    return HEADER.pack(len(payload), kind) + payload
+
+
+# builds a chat message frame
+def encode_text(msg):
+    return encode_frame(TEXT, msg.encode())
+
+
+# builds a frame carrying a JSON object
+def encode_json(kind, obj):
+    return encode_frame(kind, json.dumps(obj, separators=(",", ":")).encode())
+
+
+def decode_json(payload):
+    try:
+        obj = json.loads(bytes(payload))
+    except ValueError:
+        raise ProtocolError("malformed handshake")
+    if not isinstance(obj, dict):
+        raise ProtocolError("malformed handshake")
+    return obj
+
+
+# frame the server opens every connection with, offering compression for frames of compress_min bytes
+# and more unless compress_min is 0
+def nickname_request(compress_min=0):
+    obj = {"version": VERSION}
+    if compress_min:
+        obj["compression"] = [COMPRESSION]
+        obj["compress_min"] = compress_min
+    return encode_json(NICKNAME, obj)
+
+
+# the size from which the server that sent this NICKNAME payload takes compressed frames, 0 if it doesn't
+def compression_offer(payload):
+    try:
+        obj = decode_json(payload)
+    except ProtocolError:
+        return 0
+    if COMPRESSION not in obj.get("compression", ()):
+        return 0
+    return obj.get("compress_min", COMPRESS_MIN)
+
+
+# deflates a frame (or several back to back) into a COMPRESSED frame
+def compress(frames, level=6):
+    deflate = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=DICTIONARY)
+    return encode_frame(COMPRESSED, deflate.compress(frames) + deflate.flush())
+
+
+# the frames a COMPRESSED payload carries, at most limit bytes of them
+def decompress(payload, limit=MAX_PAYLOAD):
+    inflate = zlib.decompressobj(-15, zdict=DICTIONARY)
+    try:
+        data = inflate.decompress(payload, limit)
+    except zlib.error as e:
+        raise ProtocolError("malformed compressed frame: {}".format(e))
+    if inflate.unconsumed_tail:
+        raise ProtocolError("compressed frame inflates to more than {} bytes".format(limit))
+    if not inflate.eof:
+        raise ProtocolError("truncated compressed frame")
+    return data
+
+
+# replaces COMPRESSED frames among decoded (type, payload) pairs with the frames inside them
+def expand(frames):
+    expanded = []
+    for kind, payload in frames:
+        if kind == COMPRESSED:
+            expanded.extend(FrameDecoder().feed(decompress(payload)))
+        else:
+            expanded.append((kind, payload))
+    return expanded
+
+
+# frame a client answers the nickname request with, optionally naming the room to start in,
+# the last sequence number it has seen, to get everything after it replayed, and the compression it accepts
+def hello(nickname, room=None, since=None, compression=None):
+    obj = {"version": VERSION, "nickname": nickname}
+    if room:
+        obj["room"] = room
+    if since is not None:
+        obj["since"] = since
+    if compression:
+        obj["compression"] = compression
+    return encode_json(HELLO, obj)
+
+
+# answer to a heartbeat
+def pong():
+    return encode_frame(PONG)
+
+
+# builds a sequenced chat message frame from an encoded text
+def encode_message(seq, text):
+    return HEADER.pack(SEQ.size + len(text), MESSAGE) + SEQ.pack(seq) + text
+
+
+# packs MESSAGE frames into as few HISTORY frames as possible, each payload at most batch bytes
+def encode_history(frames, batch=READ_SIZE):
+    batches = []
+    chunk = []
+    size = 0
+    for frame in frames:
+        if chunk and size + len(frame) > batch:
+            batches.append(encode_frame(HISTORY, b"".join(chunk)))
+            chunk = []
+            size = 0
+        chunk.append(frame)
+        size += len(frame)
+    if chunk:
+        batches.append(encode_frame(HISTORY, b"".join(chunk)))
+    return batches
+
+
+# sequence numbers and texts carried by a MESSAGE or HISTORY frame
+def decode_messages(kind, payload):
+    if kind == MESSAGE:
+        return [(SEQ.unpack_from(payload)[0], payload[SEQ.size:])]
+    return [(SEQ.unpack_from(inner)[0], inner[SEQ.size:]) for _, inner in FrameDecoder().feed(payload)]
+
+
+# builds a slash command frame
+def encode_command(line):
+    return encode_frame(COMMAND, line.encode())
+
+
+# turns a line the user typed into a command or chat frame
+def encode_input(nickname, line):
+    if line.startswith("/"):
+        return encode_command(line)
+    return encode_text("{}: {}".format(nickname, line))
+
+
+# first handshake frame of both ends of a link between federated servers, the challenge the other end answers
+def link_request(nonce):
+    return encode_json(LINK, {"version": VERSION, "nonce": nonce})
+
+
+# validates the other end's first link handshake frame and returns its challenge
+def parse_link(kind, payload):
+    if kind != LINK:
+        raise ProtocolError("expected a link handshake")
+    obj = decode_json(payload)
+    if obj.get("version") != VERSION:
+        raise ProtocolError("unsupported protocol version {!r}".format(obj.get("version")))
+    nonce = obj.get("nonce")
+    if not isinstance(nonce, str) or len(nonce) != 2 * LINK_NONCE:
+        raise ProtocolError("malformed link challenge")
+    return nonce
+
+
+# proves that a node knows the secret of the link without sending it, None stands for no secret
+def link_proof(secret, nonce, node):
+    return hmac.new((secret or "").encode(), (nonce + node).encode(), hashlib.sha256).hexdigest()
+
+
+# second handshake frame: names the node and answers the other end's challenge
+def link_answer(secret, nonce, node):
+    return encode_json(LINK, {"node": node, "proof": link_proof(secret, nonce, node)})
+
+
+# validates the answer to the challenge this end sent and returns the name of the other end's node
+def parse_link_answer(kind, payload, secret, nonce):
+    if kind != LINK:
+        raise ProtocolError("expected a link handshake")
+    obj = decode_json(payload)
+    node, proof = obj.get("node"), obj.get("proof")
+    if not isinstance(node, str) or node_error(node):
+        raise ProtocolError("malformed node name")
+    if not isinstance(proof, str) or not hmac.compare_digest(proof.encode(), link_proof(secret, nonce, node).encode()):
+        raise ProtocolError("wrong link secret")
+    return node
+
+
+# checks a node name, returns the error message for an invalid one
+def node_error(node):
+    if not node or len(node) > MAX_NODE_NAME or not node.isprintable() or " " in node:
+        return "node names are 1-{} printable characters without spaces".format(MAX_NODE_NAME)
+    return None
+
+
+# one message for a RELAYED batch: its id, the nodes it went through and its room and encoded text
+def encode_relayed(message_id, path, room, text):
+    route = " ".join(path).encode()
+    name = (room or "").encode()
+    return RELAYED_ENTRY.pack(message_id, len(route), len(name), len(text)) + route + name + text
+
+
+# splits a RELAYED payload into (message id, path, room, text) tuples
+def decode_relayed(payload):
+    entries = []
+    offset = 0
+    while offset < len(payload):
+        if len(payload) - offset < RELAYED_ENTRY.size:
+            raise ProtocolError("truncated relayed message")
+        message_id, route, name, size = RELAYED_ENTRY.unpack_from(payload, offset)
+        offset += RELAYED_ENTRY.size
+        end = offset + route + name + size
+        if end > len(payload):
+            raise ProtocolError("truncated relayed message")
+        path = bytes(payload[offset:offset + route]).decode().split()
+        if not path:
+            raise ProtocolError("relayed message without an origin")
+        room = bytes(payload[offset + route:offset + route + name]).decode() or None
+        entries.append((message_id, path, room, bytes(payload[end - size:end])))
+        offset = end
+    return entries
+
+
+# announces a file by the id its uploader gave it; extra keys such as "from" or "offset" go along
+def encode_offer(transfer_id, name, size, **extra):
+    return encode_json(OFFER, dict(extra, id=transfer_id, name=name, size=size))
+
+
+# validates an OFFER payload and returns its contents
+def parse_offer(payload):
+    obj = decode_json(payload)
+    transfer_id, name, size = obj.get("id"), obj.get("name"), obj.get("size")
+    if not isinstance(transfer_id, int) or not 0 < transfer_id < 1 << 64:
+        raise ProtocolError("malformed transfer id")
+    if not isinstance(name, str) or file_name_error(name):
+        raise ProtocolError(file_name_error(name) if isinstance(name, str) else "malformed file name")
+    if not isinstance(size, int) or size <= 0:
+        raise ProtocolError("malformed file size")
+    offset = obj.get("offset", 0)
+    if not isinstance(offset, int) or not 0 <= offset <= size:
+        raise ProtocolError("malformed file offset")
+    return obj
+
+
+# checks a file name, a bare name without any directory part
+def file_name_error(name):
+    if (not name or len(name) > MAX_FILE_NAME or not name.isprintable() or "/" in name or "\\" in name
+            or name in (".", "..")):
+        return "file names are 1-{} printable characters without a directory".format(MAX_FILE_NAME)
+    return None
+
+
+def encode_resume(transfer_id, offset):
+    return encode_json(RESUME, {"id": transfer_id, "offset": offset})
+
+
+def encode_chunk(transfer_id, offset, data):
+    return HEADER.pack(CHUNK_HEADER.size + len(data), CHUNK) + CHUNK_HEADER.pack(transfer_id, offset) + data
+
+
+# splits a CHUNK payload into transfer id, offset and the bytes
+def decode_chunk(payload):
+    if len(payload) < CHUNK_HEADER.size:
+        raise ProtocolError("truncated file chunk")
+    transfer_id, offset = CHUNK_HEADER.unpack_from(payload)
+    return transfer_id, offset, payload[CHUNK_HEADER.size:]
+
+
+# checks a room name, returns the error message for an invalid one
+def room_error(room):
+    if not room or len(room) > MAX_ROOM_NAME or not room.isprintable() or " " in room:
+        return "room names are 1-{} printable characters without spaces".format(MAX_ROOM_NAME)
+    return None
+
+
+# checks a nickname, returns the error message for an invalid one; nicknames are lookup keys and /msg targets
+# and start every chat line, so they can't hold spaces or line breaks
+def nickname_error(nickname):
+    if not nickname or len(nickname) > MAX_NICKNAME or not nickname.isprintable() or " " in nickname:
+        return "nicknames are 1-{} printable characters without spaces".format(MAX_NICKNAME)
+    return None
+
+
+# wraps a frame with the room it is addressed to, room None addresses every client
+def encode_route(room, frame):
+    name = (room or "").encode()
+    return HEADER.pack(1 + len(name) + len(frame), ROUTE) + bytes((len(name),)) + name + frame
+
+
+# splits a ROUTE payload into room and frame
+def decode_route(payload):
+    size = payload[0]
+    room = bytes(payload[1:1 + size]).decode() or None
+    return room, payload[1 + size:]
+
+
+# validates a client's handshake reply and returns its contents
+def parse_hello(kind, payload):
+    if kind != HELLO:
+        raise ProtocolError("expected handshake, got frame type {}".format(kind))
+    obj = decode_json(payload)
+    if obj.get("version") != VERSION:
+        raise ProtocolError("unsupported protocol version {!r}".format(obj.get("version")))
+    nickname = obj.get("nickname")
+    if not isinstance(nickname, str) or nickname_error(nickname):
+        raise ProtocolError(nickname_error(nickname) if isinstance(nickname, str) else "missing nickname")
+    since = obj.get("since")
+    if since is not None and (not isinstance(since, int) or since < 0):
+        raise ProtocolError("malformed sequence number")
+    if obj.get("compression") not in (None, COMPRESSION):
+        raise ProtocolError("unsupported compression {!r}".format(obj.get("compression")))
+    room = obj.setdefault("room", DEFAULT_ROOM)
+    if not isinstance(room, str) or room_error(room):
+        raise ProtocolError(room_error(room) if isinstance(room, str) else "malformed room")
+    return obj
+
+
+# payload part of a whole wire frame
+def payload_of(frame):
+    return frame[HEADER.size:]
+
+
+# streaming decoder, splits whatever the socket returned into complete frames; a frame that has to be
+# buffered across reads may be at most max_payload bytes, which the owner may raise between reads
+class FrameDecoder:
+    def __init__(self, max_payload=MAX_PAYLOAD):
+        self.max_payload = max_payload
+        # tail of an incomplete frame carried over to the next read
+        self.pending = bytearray()
+
+    # splits received bytes into complete frames without copying them, returns (type, frame) pairs;
+    # each frame is a memoryview of the whole wire frame and is only valid until data's buffer is reused
+    def decode(self, data):
+        if self.pending:
+            # the limit is checked only once the frame needs more buffering, so a handshake that came in
+            # with the start of the next frame has been handled and could raise it
+            length = HEADER.unpack_from(self.pending)[0] if len(self.pending) >= HEADER.size else 0
+            if length > self.max_payload:
+                raise ProtocolError("frame of {} bytes exceeds limit".format(length))
+            self.pending += data
+            data = self.pending
+        view = memoryview(data)
+        frames = []
+        offset = 0
+        while len(view) - offset >= HEADER.size:
+            length, kind = HEADER.unpack_from(view, offset)
+            end = offset + HEADER.size + length
+            if end > len(view):
+                break
+            frames.append((kind, view[offset:end]))
+            offset = end
+        if not frames and data is self.pending:
+            # still waiting for the rest of a large frame, keep growing the same buffer
+            view.release()
+            return frames
+        self.pending = bytearray(view[offset:])
+        return frames
+
+    # adds received bytes and returns every frame they completed as (type, payload) pairs
+    def feed(self, data):
+        return [(kind, bytes(payload_of(frame))) for kind, frame in self.decode(data)]
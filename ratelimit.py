@@ -0,0 +1,51 @@
+import time
+
+
+# refills at rate tokens per second up to capacity; taking more than is there runs the bucket into debt
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = now
+
+    # takes amount tokens, returns the seconds until the debt is paid back (0 if there was enough)
+    def take(self, amount, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= amount
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+# message and byte allowance of one connection, burst is how many seconds of allowance can be saved up
+class RateLimit:
+    __slots__ = ("messages", "bytes", "throttled_since", "throttled")
+
+    def __init__(self, messages_per_second, bytes_per_second, burst):
+        now = time.monotonic()
+        self.messages = None
+        self.bytes = None
+        if messages_per_second:
+            self.messages = TokenBucket(messages_per_second, messages_per_second * burst, now)
+        if bytes_per_second:
+            self.bytes = TokenBucket(bytes_per_second, bytes_per_second * burst, now)
+        # when the connection was first held back without catching up since, and how often it was
+        self.throttled_since = None
+        self.throttled = 0
+
+    # charges one read, returns how many seconds reading should pause (0 if the client is within its limits)
+    def charge(self, messages, nbytes, now):
+        delay = 0.0
+        if self.messages is not None:
+            delay = self.messages.take(messages, now)
+        if self.bytes is not None:
+            delay = max(delay, self.bytes.take(nbytes, now))
+        if not delay:
+            self.throttled_since = None
+        else:
+            self.throttled += 1
+            if self.throttled_since is None:
+                self.throttled_since = now
+        return delay
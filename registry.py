@@ -0,0 +1,70 @@
+import itertools
+import threading
+
+
+# every connected client, looked up by id or nickname in O(1); membership lists are immutable tuples
+# replaced on every change, so broadcasts iterate them without taking the lock
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.by_id = {}
+        self.by_nickname = {}
+        # snapshot of every client, and room name -> snapshot of its members
+        self.everyone = ()
+        self.rooms = {}
+
+    def __len__(self):
+        return len(self.by_id)
+
+    # gives a freshly accepted connection its id
+    def assign_id(self, client):
+        client.id = next(self.ids)
+
+    # adds a client under its nickname to a room, returns False if the nickname is taken
+    def add(self, client, room):
+        with self.lock:
+            if client.nickname in self.by_nickname:
+                return False
+            self.by_id[client.id] = client
+            self.by_nickname[client.nickname] = client
+            self.everyone = self.everyone + (client,)
+            self.move(client, room)
+            return True
+
+    # removes a client, returns False if it was not registered (or already removed)
+    def remove(self, client):
+        with self.lock:
+            if self.by_id.pop(client.id, None) is None:
+                return False
+            del self.by_nickname[client.nickname]
+            self.everyone = tuple(other for other in self.everyone if other is not client)
+            self.move(client, None)
+            return True
+
+    # moves a registered client into a room, leaving the one it was in
+    def enter(self, client, room):
+        with self.lock:
+            if client.id in self.by_id:
+                self.move(client, room)
+
+    def move(self, client, room):
+        if client.room is not None:
+            members = tuple(other for other in self.rooms.get(client.room, ()) if other is not client)
+            if members:
+                self.rooms[client.room] = members
+            else:
+                self.rooms.pop(client.room, None)
+        if room is not None:
+            client.room = room
+            self.rooms[room] = self.rooms.get(room, ()) + (client,)
+
+    def get(self, client_id):
+        return self.by_id.get(client_id)
+
+    def find(self, nickname):
+        return self.by_nickname.get(nickname)
+
+    # clients of a room, every client if room is None
+    def members(self, room=None):
+        return self.everyone if room is None else self.rooms.get(room, ())
@@ -0,0 +1,37 @@
+import tempfile
+from array import array
+
+
+# lines trimmed off the top of a chat window, kept on disk as a stack of chunks
+# so the newest trimmed chunk is the first to be paged back in
+class Scrollback:
+    def __init__(self, path=None):
+        self.file = open(path, "w+b") if path else tempfile.TemporaryFile()
+        # start offset of every chunk, a few bytes per chunk instead of per line
+        self.offsets = array("Q")
+        self.end = 0
+
+    def __len__(self):
+        return len(self.offsets)
+
+    # stores a chunk of text, the newest chunk goes on top
+    def push(self, text):
+        data = text.encode()
+        self.file.seek(self.end)
+        self.file.write(data)
+        self.offsets.append(self.end)
+        self.end += len(data)
+
+    # removes the newest chunk and returns its text, or None if nothing was trimmed
+    def pop(self):
+        if not self.offsets:
+            return None
+        start = self.offsets.pop()
+        self.file.seek(start)
+        data = self.file.read(self.end - start)
+        self.file.truncate(start)
+        self.end = start
+        return data.decode(errors="replace")
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,228 @@
+import bisect
+import collections
+import math
+import re
+import threading
+import time
+from array import array
+
+import protocol
+
+TOKEN = re.compile(r"\w+")
+MIN_TOKEN = 2
+MAX_TOKEN = 32
+# results per search, how many of the newest matching messages are ranked to pick them,
+# and how many postings a search may walk to find those, a chunk at a time
+RESULTS = 10
+CANDIDATES = 5000
+MAX_SCAN = 200000
+SCAN_CHUNK = 4096
+# stored messages indexed at a time when the index is rebuilt from the store
+LOAD_BATCH = 1000
+# units of since:<n>m|h|d
+UNITS = {"m": 60, "h": 3600, "d": 86400}
+
+
+def words(text):
+    return [token for token in TOKEN.findall(text.lower()) if MIN_TOKEN <= len(token) <= MAX_TOKEN]
+
+
+# lower-cased words of a message, the nickname of a "nick: text" message is indexed as from:nick
+def tokenize(text):
+    tokens = words(text)
+    nickname, sep, _ = text.partition(": ")
+    if sep and " " not in nickname:
+        tokens.append("from:" + nickname.lower())
+    return tokens
+
+
+# splits a search into the terms that must match and the unix time results have to be newer than
+def parse_query(query):
+    terms = []
+    since = 0.0
+    for word in query.lower().split():
+        if word.startswith("from:") and len(word) > 5:
+            terms.append(word)
+        elif word.startswith("since:") and word[-1:] in UNITS and word[6:-1].isdigit():
+            since = time.time() - int(word[6:-1]) * UNITS[word[-1]]
+        else:
+            terms.extend(words(word))
+    return terms, since
+
+
+# incremental inverted index over chat messages: token -> sequence numbers of the messages containing it
+# (once per occurrence), bounded to max_postings entries by forgetting the oldest messages;
+# messages are queued and indexed by a thread of its own, off the broadcast path, which first
+# indexes what the store kept from before a restart
+class SearchIndex:
+    def __init__(self, max_postings=2000000, store=None):
+        self.max_postings = max_postings
+        # messages up to last_stored are read back from the store, later ones are queued as they are sent
+        self.store = store
+        self.last_stored = store.last_seq if store is not None else 0
+        self.loading = store is not None
+        self.postings = {}
+        self.size = 0
+        # one entry per indexed message, in sequence order
+        self.seqs = array("Q")
+        self.times = array("d")
+        self.room_ids = array("I")
+        self.rooms = {None: 0}
+        self.lock = threading.Lock()
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+
+        index_thread = threading.Thread(target=self.run)
+        index_thread.daemon = True
+        index_thread.start()
+
+    # queues an encoded message text for indexing
+    def add(self, seq, room, text):
+        self.queue.append((seq, room, text, time.time()))
+        if len(self.queue) == 1:
+            with self.cond:
+                self.cond.notify()
+
+    def run(self):
+        if self.store is not None:
+            self.load()
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait(1.0)
+            batch = []
+            while self.queue:
+                batch.append(self.queue.popleft())
+            self.index_batch(batch)
+
+    # indexes the stored messages a batch at a time, searches find what is indexed so far meanwhile
+    def load(self):
+        batch = []
+        for seq, stamp, room, frame in self.store.records(self.last_stored):
+            text = protocol.decode_messages(protocol.MESSAGE, protocol.payload_of(frame))[0][1]
+            batch.append((seq, room, text, stamp))
+            if len(batch) >= LOAD_BATCH:
+                self.index_batch(batch)
+                batch = []
+        self.index_batch(batch)
+        self.loading = False
+
+    def index_batch(self, batch):
+        with self.lock:
+            for seq, room, text, stamp in batch:
+                self.index(seq, room, bytes(text).decode(errors="replace"), stamp)
+            while self.size > self.max_postings:
+                self.evict()
+
+    def index(self, seq, room, text, stamp):
+        if self.seqs and seq <= self.seqs[-1]:
+            # numbering restarted, postings must stay sorted
+            self.clear()
+        self.seqs.append(seq)
+        self.times.append(stamp)
+        self.room_ids.append(self.rooms.setdefault(room, len(self.rooms)))
+        tokens = tokenize(text)
+        for token in tokens:
+            postings = self.postings.get(token)
+            if postings is None:
+                postings = self.postings[token] = array("Q")
+            postings.append(seq)
+        self.size += len(tokens)
+
+    def clear(self):
+        self.postings.clear()
+        self.size = 0
+        del self.seqs[:], self.times[:], self.room_ids[:]
+
+    # forgets the oldest tenth of the messages
+    def evict(self):
+        drop = max(1, len(self.seqs) // 10)
+        cutoff = self.seqs[drop] if drop < len(self.seqs) else self.seqs[-1] + 1
+        del self.seqs[:drop], self.times[:drop], self.room_ids[:drop]
+        size = 0
+        for token in list(self.postings):
+            postings = self.postings[token]
+            del postings[:bisect.bisect_left(postings, cutoff)]
+            if postings:
+                size += len(postings)
+            else:
+                del self.postings[token]
+        self.size = size
+
+    # (seq, unix time) of the best matches for a query, best first; every word must match, from:<nick> and
+    # since:<n>m|h|d narrow the search, messages sent to other rooms are left out
+    def search(self, query, room, limit=RESULTS):
+        terms, since = parse_query(query)
+        if not terms:
+            return []
+        with self.lock:
+            sizes = {term: len(self.postings.get(term, ())) for term in terms}
+            total = len(self.seqs)
+            allowed = {0, self.rooms.get(room, -1)}
+        if not min(sizes.values()):
+            return []
+        terms = sorted(sizes, key=sizes.get)
+        weights = [math.log(1 + total / sizes[term]) for term in terms]
+        scored = []
+        upper = None
+        scanned = 0
+        # walk the rarest term's postings from the newest message back a chunk at a time, taking the lock for
+        # one chunk only so messages keep being indexed during a long search
+        while scanned < MAX_SCAN and len(scored) < CANDIDATES:
+            with self.lock:
+                matches, upper, size = self.scan(terms, upper, allowed)
+            if not size:
+                break
+            scanned += size
+            for seq, stamp, counts in matches:
+                if stamp < since:
+                    scanned = MAX_SCAN
+                    break
+                score = sum(weight * count / (count + 1.0) for weight, count in zip(weights, counts))
+                scored.append((score, seq, stamp))
+        scored.sort(reverse=True)
+        return [(seq, stamp) for _, seq, stamp in scored[:limit]]
+
+    # the messages among the next chunk of the first term's postings below sequence number upper that contain
+    # every term and were sent to an allowed room, newest first as (seq, time, occurrences of each term);
+    # returns them with the chunk's lowest sequence number and its size, 0 once there is nothing left
+    def scan(self, terms, upper, allowed):
+        rarest = self.postings.get(terms[0])
+        if not rarest:
+            return [], upper, 0
+        end = len(rarest) if upper is None else bisect.bisect_left(rarest, upper)
+        if not end:
+            return [], upper, 0
+        # a message's postings stay in one chunk, or its occurrences would be counted short
+        start = bisect.bisect_left(rarest, rarest[max(0, end - SCAN_CHUNK)])
+        low = rarest[start]
+        counts = [collections.Counter(rarest[start:end])]
+        seqs = set(counts[0])
+        for term in terms[1:]:
+            postings = self.postings.get(term, array("Q"))
+            first = bisect.bisect_left(postings, low)
+            last = bisect.bisect_right(postings, rarest[end - 1], first)
+            if last - first <= 8 * len(seqs):
+                # counting every posting in the range is cheaper than looking up each message
+                found = collections.Counter(postings[first:last])
+            else:
+                found = {}
+                for seq in seqs:
+                    position = bisect.bisect_left(postings, seq, first, last)
+                    count = bisect.bisect_right(postings, seq, position, last) - position
+                    if count:
+                        found[seq] = count
+            counts.append(found)
+            seqs &= found.keys()
+            if not seqs:
+                break
+        matches = []
+        for seq in sorted(seqs, reverse=True):
+            position = bisect.bisect_left(self.seqs, seq)
+            if self.room_ids[position] in allowed:
+                matches.append((seq, self.times[position], [count[seq] for count in counts]))
+        return matches, low, end - start
+
+    def stats(self):
+        return {"messages": len(self.seqs), "tokens": len(self.postings), "postings": self.size,
+                "queued": len(self.queue), "loading": self.loading}
@@ -1,51 +1,804 @@
+import argparse
+import os
 import socket
 import threading
+import time
+
+import protocol
+from files import WINDOW, FileShare, read_chunk
+from history import History
+from lifecycle import Heartbeat
+from metrics import Metrics, log_stats, serve_stats
+from outbox import DROP_OLDEST, POLICIES, Outbox, Overflow
+from ratelimit import RateLimit
+from registry import Registry
+from search import SearchIndex
+from store import MessageLog
+
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 16
+
+
+# average frame size from which gathering with sendmsg beats joining into one copy
+GATHER_MIN = 8 * 1024
+
+
+# writes a list of buffers with scatter-gather sendmsg calls, no joining into one big copy
+def send_gathered(sock, buffers):
+    buffers = [memoryview(buffer) for buffer in buffers]
+    first = 0
+    while first < len(buffers):
+        sent = sock.sendmsg(buffers[first:first + IOV_MAX])
+        while sent and sent >= len(buffers[first]):
+            sent -= len(buffers[first])
+            first += 1
+        if sent:
+            buffers[first] = buffers[first][sent:]
+
+
+# writes a batch of frames with as few syscalls as possible; small frames are cheaper
+# to join than to hand to the kernel one iovec at a time, large ones are gathered
+def send_buffers(sock, buffers):
+    if len(buffers) == 1:
+        sock.sendall(buffers[0])
+    elif hasattr(sock, "sendmsg") and sum(map(len, buffers)) >= GATHER_MIN * len(buffers):
+        send_gathered(sock, buffers)
+    else:
+        sock.sendall(b"".join(buffers))
+
+
+# one client of the threaded engine, with its own bounded outbound queue and writer thread
+class Connection:
+    __slots__ = ("server", "sock", "addr", "id", "nickname", "room", "outbox", "connected_at", "last_seen",
+                 "pinged_at", "bytes_in", "messages_in", "limit", "compress", "downloads", "decoder")
+
+    def __init__(self, server, sock, addr):
+        self.server = server
+        self.sock = sock
+        self.addr = addr
+        self.id = None
+        self.nickname = None
+        self.room = None
+        self.outbox = Outbox(server.queue_limit, server.overflow, server.block_timeout)
+        self.connected_at = self.last_seen = time.monotonic()
+        self.pinged_at = None
+        self.bytes_in = 0
+        self.messages_in = 0
+        self.limit = server.rate_limit()
+        # set in the handshake if the client takes compressed frames
+        self.compress = False
+        # files being sent to the client, their chunks go out behind every other frame
+        self.downloads = []
+        # small frames only until the handshake is accepted
+        self.decoder = protocol.FrameDecoder(protocol.MAX_HANDSHAKE)
+
+        write_thread = threading.Thread(target=self.write)
+        write_thread.daemon = True
+        write_thread.start()
+
+    # queues a frame, raises Overflow if the overflow policy gives up on the client; with wait=False a full
+    # BLOCK queue takes the frame anyway and False is returned
+    def send(self, data, wait=True):
+        return self.outbox.put(data, wait)
+
+    # queues size bytes of a file from offset in the outbox's low-priority lane
+    def send_chunk(self, transfer, offset, size):
+        self.outbox.put_bulk(protocol.encode_chunk(transfer.id, offset, read_chunk(transfer, offset, size)))
+
+    # whether the next file chunk can be queued
+    def bulk_room(self):
+        return not self.outbox.closed and len(self.outbox.bulk) < WINDOW
+
+    # writer thread, drains everything queued onto the socket in one gathered write
+    def write(self):
+        while True:
+            frames = self.outbox.get_all(self.server.flush_window, self.server.flush_bytes)
+            if not frames:
+                break
+            try:
+                send_buffers(self.sock, frames)
+            except socket.error:
+                self.server.disconnect(self, "send failed")
+                break
+            if self.downloads:
+                self.server.files.pump(self)
+        self.sock.close()
+
+    # stops the connection, flush=False discards queued frames instead of delivering them first
+    def close(self, flush=True):
+        if not flush:
+            self.outbox.take_all()
+        # shut down before waking the writer, which closes the socket; a reader blocked in recv
+        # only returns if the socket is shut down, closing the descriptor would leave it hanging
+        try:
+            self.sock.shutdown(socket.SHUT_RD if flush else socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.outbox.close()
 
 
 class Server:
-    def __init__(self, host, port, peers):
+    def __init__(self, host, port, peers, display=print, queue_limit=1024, overflow=DROP_OLDEST,
+                 block_timeout=5.0, relay=False, flush_window=0.0, flush_bytes=64 * 1024, reuse_port=False,
+                 bus_path=None, history=10000, history_bytes=4 * 1024 * 1024, metrics=False, stats_port=None,
+                 stats_interval=None, heartbeat=30.0, heartbeat_timeout=30.0, rate_messages=20.0,
+                 rate_bytes=256 * 1024, rate_burst=2.0, flood_timeout=10.0, store=None,
+                 store_segment_bytes=64 * 1024 * 1024, store_commit_interval=0.05, search=False,
+                 search_postings=2000000, compress_min=protocol.COMPRESS_MIN, node=None, federation_port=None,
+                 federation_host="127.0.0.1", links=(), link_secret=None, link_window=0.005,
+                 link_batch_bytes=64 * 1024, files=None,
+                 file_max_bytes=64 * 1024 * 1024, file_spool_bytes=1024 * 1024 * 1024, file_ttl=86400.0):
         self.host = host
         self.port = port
         self.peers = peers
-        self.clients = []
-        self.nicknames = []
+        self.display = display
+        self.queue_limit = queue_limit
+        self.overflow = overflow
+        self.block_timeout = block_timeout
+        # relay mode forwards chat frames without decoding or displaying them
+        self.relay = relay
+        # coalescing window: frames queued within flush_window seconds of each other,
+        # up to flush_bytes, leave in one write per client
+        self.flush_window = flush_window
+        self.flush_bytes = flush_bytes
+        # unix socket of the bus connecting the worker processes that share the port
+        self.bus_path = bus_path
+        self.bus = None
+        # connected clients by id, nickname and room; room traffic only touches the room's members
+        self.registry = Registry()
+        # recent messages, replayed to clients that ask for them in the handshake
+        self.history = History(history, history_bytes)
+        # optional durable log of every message, numbering carries on from what it holds
+        self.store = MessageLog(store, store_segment_bytes, store_commit_interval) if store else None
+        if self.store is not None:
+            self.history.seq = self.store.last_seq
+        # clients that ask for it get frames of compress_min bytes and more deflated, 0 turns compression off
+        self.compress_min = compress_min
+        self.greeting = protocol.nickname_request(compress_min)
+        # optional file sharing, uploads are spooled to this directory and streamed from there
+        self.files = FileShare(self, files, file_max_bytes, file_spool_bytes, file_ttl) if files else None
+        # optional full-text index for /search, filled by a thread of its own from the store and live traffic
+        self.search_index = SearchIndex(search_postings, self.store) if search else None
+        # instrumentation, None switches every hot-path measurement off
+        self.metrics = Metrics() if metrics or stats_port or stats_interval else None
+        self.stats_port = stats_port
+        self.stats_interval = stats_interval
+        # idle connections are pinged after heartbeat seconds and dropped if they stay silent, 0 disables
+        self.heartbeat = Heartbeat(self, heartbeat, heartbeat_timeout) if heartbeat else None
+        # per-connection flood protection, reads pause while a client is over its allowance
+        # and a client that stays over it for flood_timeout seconds is dropped; 0 turns a limit off
+        self.rate_messages = rate_messages
+        self.rate_bytes = rate_bytes
+        self.rate_burst = rate_burst
+        self.flood_timeout = flood_timeout
+        # peer servers linked into one chat: links are dialed, federation_port takes links from peers;
+        # messages to peers are batched for up to link_window seconds or link_batch_bytes
+        self.node = node or "{}:{}".format(socket.gethostname(), port)
+        self.federation_port = federation_port
+        self.federation_host = federation_host
+        self.links = links
+        # required from linking peers and sent to them, if set
+        self.link_secret = link_secret
+        self.link_window = link_window
+        self.link_batch_bytes = link_batch_bytes
+        self.federation = None
 
         # start server
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_socket.bind((self.host, self.port))
         self.server_socket.listen(self.peers)
-        print("Listening at {}".format(self.server_socket.getsockname()))
-        self.main(self.server_socket)
+        self.display("Listening at {}".format(self.server_socket.getsockname()))
+
+    # broadcast a message to all connected clients (or the members of one room), framed once for every recipient
+    def broadcast(self, msg, room=None):
+        self.publish(msg.encode(), room)
+        self.display(msg if room in (None, protocol.DEFAULT_ROOM) else "[{}] {}".format(room, msg))
+
+    # sends an encoded text to its room (or everyone); with worker processes the bus hub numbers it
+    # and hands it back to every worker, this one included; linked servers get a copy
+    def publish(self, text, room=None):
+        if self.bus is not None:
+            self.bus.publish(protocol.encode_route(room, protocol.encode_frame(protocol.TEXT, text)))
+        else:
+            self.record(room, text)
+        if self.federation is not None:
+            self.federation.publish(room, text)
+
+    # takes a message published on a linked server, called from the link's thread
+    def federated(self, room, text):
+        self.record(room, text)
+
+    # stamps a text with its sequence number, keeps it in the history and fans it out; it is queued under
+    # the history lock, so every client gets messages in the order of their numbers and a client joining
+    # meanwhile gets it in its replay instead, but without waiting: a client whose queue is full is only
+    # waited for, or dropped, once the lock is released, and holds up this message only
+    def record(self, room, text, seq=None):
+        late = []
+        with self.history.lock:
+            frame = self.history.add(room, text, seq)
+            if self.store is not None:
+                self.store.append(self.history.seq, room, frame)
+            if self.search_index is not None:
+                self.search_index.add(self.history.seq, room, text)
+            self.deliver(frame, room, late=late)
+        self.settle(late)
+
+    # deals with the clients a frame was queued for without waiting, see send
+    def settle(self, late):
+        for client, error in late:
+            if error is None:
+                try:
+                    client.outbox.wait_for_room()
+                except Overflow as e:
+                    error = str(e)
+            if error is not None:
+                self.disconnect(client, error)
+
+    # queues an already framed message for the clients of this process that are in the room
+    # (every client if room is None), all of them share the same bytes
+    def deliver(self, data, room=None, late=None):
+        members = self.registry.members(room)
+        if self.metrics is None:
+            self.fan_out(members, data, late)
+            return
+        start = time.perf_counter()
+        self.fan_out(members, data, late)
+        self.metrics.observe("fanout_us", (time.perf_counter() - start) * 1e6)
+        self.metrics.inc("messages_out", len(members))
+        self.metrics.inc("bytes_out", len(data) * len(members))
+
+    # sends the same frame to many clients; a large one is compressed once, for the first client that takes it,
+    # and the compressed copy is shared with every other one
+    def fan_out(self, members, data, late=None):
+        if not self.compress_min or len(data) < self.compress_min:
+            for client in members:
+                self.send(client, data, late)
+            return
+        packed = None
+        for client in members:
+            if client.compress:
+                if packed is None:
+                    packed = self.pack(data)
+                self.send(client, packed, late)
+            else:
+                self.send(client, data, late)
+
+    # compressed version of a frame, or the frame itself if compressing doesn't make it smaller
+    def pack(self, data):
+        packed = protocol.compress(data)
+        if self.metrics is not None:
+            self.metrics.inc("frames_compressed")
+            self.metrics.inc("bytes_saved_by_compression", max(0, len(data) - len(packed)))
+        return packed if len(packed) < len(data) else data
+
+    # queues a frame meant for one client only, compressed if the client takes it and it is large enough
+    def send_packed(self, client, data):
+        if client.compress and self.compress_min and len(data) >= self.compress_min:
+            data = self.pack(data)
+        self.send(client, data)
+
+    # passes a chat message from a client on to the client's room
+    def relay_text(self, client, frame):
+        self.publish(bytes(protocol.payload_of(frame)), client.room)
+        if not self.relay:
+            msg = bytes(protocol.payload_of(frame)).decode(errors="replace")
+            self.display(msg if client.room == protocol.DEFAULT_ROOM else "[{}] {}".format(client.room, msg))
+
+    # tells a single client something
+    def notice(self, client, msg):
+        self.send_packed(client, protocol.encode_text(msg))
+
+    # sends a private message straight to one client, the sender gets a copy
+    def direct(self, client, nickname, text):
+        target = self.registry.find(nickname)
+        if target is None:
+            self.notice(client, "No one called {} is here".format(nickname))
+            return
+        frame = protocol.encode_text("{} -> {}: {}".format(client.nickname, nickname, text))
+        self.send(target, frame)
+        if target is not client:
+            self.send(client, frame)
+
+    # handles a slash command from a client
+    def command(self, client, line):
+        name, _, arg = line.strip().partition(" ")
+        arg = arg.strip()
+        if name == "/join":
+            error = protocol.room_error(arg)
+            if error:
+                self.notice(client, error)
+            elif arg != client.room:
+                self.broadcast("{} left #{}".format(client.nickname, client.room), client.room)
+                self.registry.enter(client, arg)
+                self.broadcast("{} joined #{}".format(client.nickname, arg), arg)
+        elif name == "/leave":
+            if client.room != protocol.DEFAULT_ROOM:
+                self.command(client, "/join " + protocol.DEFAULT_ROOM)
+        elif name == "/rooms":
+            rooms = sorted(self.registry.rooms.items())
+            self.notice(client, "Rooms: " + ", ".join("#{} ({})".format(room, len(members)) for room, members in rooms))
+        elif name == "/history":
+            self.history_page(client, arg)
+        elif name == "/search":
+            self.search_messages(client, arg)
+        elif name in ("/get", "/files"):
+            if self.files is None:
+                self.notice(client, "File sharing is off on this server")
+            elif name == "/get":
+                self.files.get(client, arg)
+            else:
+                self.files.list(client)
+        elif name == "/msg":
+            nickname, _, text = arg.partition(" ")
+            if not nickname or not text.strip():
+                self.notice(client, "Usage: /msg <nickname> <text>")
+            else:
+                self.direct(client, nickname, text.strip())
+        else:
+            self.notice(client, "Unknown command {}, try /join <room>, /leave, /rooms, /msg <nickname> <text>"
+                                ", /history [<seq> | @<time>], /search <words>, /files or /get <id> [<offset>]".format(name))
+
+    # runs a lookup that may have to read from disk and hands the result to reply(client, result),
+    # a ValueError from the lookup means the request was malformed
+    def lookup(self, client, usage, reply, function, *args):
+        try:
+            result = function(*args)
+        except ValueError:
+            self.notice(client, usage)
+            return
+        reply(client, result)
+
+    # looks up a page of stored messages: the latest ones, the ones before a sequence number,
+    # or with @<unix time> the ones from that time on
+    def find_page(self, room, arg):
+        if arg.startswith("@"):
+            return self.store.page_since(room, float(arg[1:]))
+        return self.store.page(room, int(arg) if arg else None)
+
+    # sends a client a page of its room's stored history
+    def history_page(self, client, arg):
+        if self.store is None:
+            self.notice(client, "This server does not store history")
+            return
+        self.lookup(client, "Usage: /history [<seq> | @<unix time>]", self.send_page, self.find_page, client.room, arg)
 
-    def broadcast(self, msg):
-        for client in self.clients:
-            client.sendall(msg.encode())
-        print(msg)
+    def send_page(self, client, frames):
+        if not frames:
+            self.notice(client, "No more history")
+        for batch in self.pack_history(client, frames):
+            self.send(client, batch)
 
+    # (seq, time, frame) of the best matches for a search in a room, texts come from the history or the store
+    def find_messages(self, room, query):
+        results = []
+        for seq, stamp in self.search_index.search(query, room):
+            frame = self.history.get(seq)
+            if frame is None and self.store is not None:
+                frame = self.store.find(seq)
+            if frame is not None:
+                results.append((seq, stamp, frame))
+        return results
+
+    # answers /search with one notice listing the matches
+    def search_messages(self, client, query):
+        usage = "Usage: /search <words> [from:<nickname>] [since:<n>m|h|d]"
+        if self.search_index is None:
+            self.notice(client, "This server does not index messages")
+        elif not query:
+            self.notice(client, usage)
+        else:
+            self.lookup(client, usage, self.send_results, self.find_messages, client.room, query)
+
+    def send_results(self, client, results):
+        if not results:
+            self.notice(client, "No messages found")
+            return
+        lines = ["Found {}:".format(len(results))]
+        for seq, stamp, frame in results:
+            text = protocol.decode_messages(protocol.MESSAGE, protocol.payload_of(frame))[0][1]
+            lines.append("#{} {} {}".format(seq, time.strftime("%Y-%m-%d %H:%M", time.localtime(stamp)),
+                                            text.decode(errors="replace")))
+        self.notice(client, "\n".join(lines))
+
+    # token buckets for a new connection, None if neither limit is set
+    def rate_limit(self):
+        if not self.rate_messages and not self.rate_bytes:
+            return None
+        return RateLimit(self.rate_messages, self.rate_bytes, self.rate_burst)
+
+    # charges a read of some frames and bytes to the client's limits, returns the seconds to stop reading
+    # from it; a client that would be held back for longer than flood_timeout is disconnected instead
+    def throttle(self, client, frames, nbytes):
+        now = time.monotonic()
+        delay = client.limit.charge(frames, nbytes, now)
+        if not delay:
+            return 0.0
+        if self.metrics is not None:
+            self.metrics.inc("throttled")
+        if now + delay - client.limit.throttled_since > self.flood_timeout:
+            if self.metrics is not None:
+                self.metrics.inc("flood_disconnects")
+            self.disconnect(client, "kept sending faster than allowed for {}s".format(self.flood_timeout))
+            return 0.0
+        return delay
+
+    # handles one frame from a client, heartbeats are answered before and after the handshake
+    def receive(self, client, kind, frame):
+        if kind == protocol.PONG:
+            return
+        if kind == protocol.PING:
+            self.send(client, protocol.pong())
+        elif kind == protocol.COMPRESSED:
+            raise protocol.ProtocolError("nested compressed frame")
+        elif client.nickname is None:
+            self.join(client, kind, protocol.payload_of(frame))
+        else:
+            self.dispatch(client, kind, frame)
+
+    # the frames of a read with every COMPRESSED frame replaced by the frames inside it, inflated only once
+    # the reader gets to it; readers handle and rate limit each of them as if it had been sent on its own,
+    # so a batch is charged for every frame and every inflated byte in it
+    def unpack(self, client, frames):
+        for kind, frame in frames:
+            if kind == protocol.COMPRESSED:
+                yield from self.inflate(client, frame)
+            else:
+                yield kind, frame
+
+    def inflate(self, client, frame):
+        if not client.compress:
+            raise protocol.ProtocolError("compression was not negotiated")
+        decoder = protocol.FrameDecoder()
+        frames = decoder.decode(protocol.decompress(protocol.payload_of(frame)))
+        if decoder.pending:
+            raise protocol.ProtocolError("compressed frame ends inside a frame")
+        if len(frames) > protocol.MAX_COMPRESSED_FRAMES:
+            raise protocol.ProtocolError("compressed frame carries more than {} frames".format(
+                protocol.MAX_COMPRESSED_FRAMES))
+        return frames
+
+    # handles one frame from a client that finished the handshake
+    def dispatch(self, client, kind, frame):
+        client.messages_in += 1
+        if self.metrics is not None:
+            self.metrics.inc("messages_in")
+        if kind == protocol.TEXT:
+            self.relay_text(client, frame)
+        elif kind == protocol.COMMAND:
+            self.command(client, bytes(protocol.payload_of(frame)).decode(errors="replace"))
+        elif kind in (protocol.OFFER, protocol.CHUNK) and self.files is None:
+            self.notice(client, "File sharing is off on this server")
+        elif kind == protocol.OFFER:
+            self.files.offer(client, protocol.payload_of(frame))
+        elif kind == protocol.CHUNK:
+            self.files.chunk(client, frame)
+
+    # broadcast a message from a thread that does not belong to the server
+    def announce(self, msg):
+        self.broadcast(msg)
+
+    # queues a frame for a single client, dropping the client if its queue overflows; given a late list,
+    # nothing waits for room and nobody is dropped here, (client, reason) is added to late instead, with
+    # reason None for a full queue that has yet to drain, for settle to take care of once no lock is held
+    def send(self, client, data, late=None):
+        try:
+            if client.send(data, late is None) is False:
+                late.append((client, None))
+        except Overflow as e:
+            if late is None:
+                self.disconnect(client, str(e))
+            else:
+                late.append((client, str(e)))
+
+    # forgets a client whose connection is gone, only the first call for a client returns True
+    def unregister(self, client):
+        if not self.registry.remove(client):
+            return False
+        if self.metrics is not None:
+            self.metrics.inc("connections_closed")
+        return True
+
+    # drops a client and tells its room; unless flush is set, what is still queued for it is discarded
+    def disconnect(self, client, reason, flush=False):
+        if self.files is not None:
+            self.files.forget(client)
+        if self.unregister(client):
+            self.display("{} disconnected: {}".format(client.nickname, reason))
+            self.broadcast("{} left the chat!".format(client.nickname), client.room)
+        client.close(flush)
+
+    # traffic and outbound queue of every client, by connection id
+    def connection_stats(self):
+        now = time.monotonic()
+        stats = {}
+        for client in self.registry.everyone:
+            stats[client.id] = dict(client.outbox.stats(), nickname=client.nickname, room=client.room,
+                                    address=str(client.addr), seconds=round(now - client.connected_at, 1),
+                                    bytes_in=client.bytes_in, messages_in=client.messages_in,
+                                    throttled=client.limit.throttled if client.limit is not None else 0)
+        return stats
+
+    # everything the stats endpoint and the periodic stats log report
+    def stats(self):
+        stats = self.metrics.snapshot() if self.metrics is not None else {}
+        queues = [client.outbox.stats() for client in self.registry.everyone]
+        stats.update({
+            "connections": len(queues),
+            "rooms": len(self.registry.rooms),
+            "threads": threading.active_count(),
+            "queue_depth_total": sum(queue["depth"] for queue in queues),
+            "queue_depth_max": max((queue["depth"] for queue in queues), default=0),
+            "queue_high_water_max": max((queue["high_water"] for queue in queues), default=0),
+            "queue_dropped_total": sum(queue["dropped"] for queue in queues),
+            "history": self.history.stats(),
+        })
+        if self.store is not None:
+            stats["store"] = self.store.stats()
+        if self.search_index is not None:
+            stats["search"] = self.search_index.stats()
+        if self.federation is not None:
+            stats["federation"] = self.federation.stats()
+        if self.files is not None:
+            stats["files"] = self.files.stats()
+        return stats
+
+    # HISTORY frames carrying the given MESSAGE frames, compressed if the client takes it
+    def pack_history(self, client, frames):
+        batches = protocol.encode_history(frames)
+        if client.compress and self.compress_min:
+            batches = [self.pack(batch) if len(batch) >= self.compress_min else batch for batch in batches]
+        return batches
+
+    # runs work that may take a while for a client and hands its result to then(result);
+    # the threaded engine does it right away, on the client's own thread
+    def offload(self, client, then, function, *args):
+        then(function(*args))
+
+    # takes a client's answer to the NICKNAME handshake; the replay it asks for is packed without holding
+    # the history lock, which is only taken to look the messages up and again to admit the client
+    def join(self, client, kind, payload):
+        hello = protocol.parse_hello(kind, payload)
+        client.nickname = hello["nickname"]
+        client.compress = bool(self.compress_min) and hello.get("compression") == protocol.COMPRESSION
+        if hello.get("since") is None:
+            self.admit(client, hello["room"], None, [])
+            return
+        with self.history.lock:
+            frames = self.history.since(hello["since"], hello["room"])
+            seq = self.history.seq
+        self.offload(client, lambda batches: self.admit(client, hello["room"], seq, batches),
+                     self.pack_history, client, frames)
+
+    # registers a client and queues its replay, followed by whatever was sent after message seq while the
+    # replay was packed, before any live message can reach it
+    def admit(self, client, room, seq, batches):
+        with self.history.lock:
+            if not self.registry.add(client, room):
+                nickname, client.nickname = client.nickname, None
+                raise protocol.ProtocolError("nickname {} is already taken".format(nickname))
+            client.decoder.max_payload = protocol.MAX_PAYLOAD
+            if seq is not None:
+                batches = batches + self.pack_history(client, self.history.since(seq, room))
+            for batch in batches:
+                self.send(client, batch)
+        self.broadcast("{} connected to the chat!".format(client.nickname), client.room)
+
+    # method for handling a single client, reads into one reusable buffer
     def handle(self, client):
+        if self.metrics is not None:
+            self.metrics.inc("handler_threads")
+        try:
+            self.read_frames(client)
+        finally:
+            if self.metrics is not None:
+                self.metrics.inc("handler_threads", -1)
+
+    # reads until the peer closes the connection or breaks the protocol, then removes the client
+    def read_frames(self, client):
+        buffer = memoryview(bytearray(protocol.READ_SIZE))
         while True:
             try:
-                msg = client.recv(1024).decode()
-                self.broadcast(msg)
-            except socket.error:
-                print("Error!")
+                nbytes = client.sock.recv_into(buffer)
+                if not nbytes:
+                    self.disconnect(client, "connection closed")
+                    break
+                client.last_seen = time.monotonic()
+                client.bytes_in += nbytes
+                if self.metrics is not None:
+                    self.metrics.inc("bytes_in", nbytes)
+                for kind, frame in self.unpack(client, client.decoder.decode(buffer[:nbytes])):
+                    self.receive(client, kind, frame)
+                    # a client over its limit is left unread, so its socket buffers fill up and TCP slows it down;
+                    # file chunks are bounded by the file size limit instead
+                    if client.limit is not None and kind != protocol.CHUNK:
+                        delay = self.throttle(client, 1, len(frame))
+                        if client.outbox.closed:
+                            return
+                        if delay:
+                            time.sleep(delay)
+            except protocol.ProtocolError as e:
+                if self.metrics is not None:
+                    self.metrics.inc("protocol_errors")
+                client.outbox.put(protocol.encode_frame(protocol.ERROR, str(e).encode()))
+                self.disconnect(client, str(e), flush=True)
+                break
+            except socket.error as e:
+                self.disconnect(client, str(e))
                 break
 
+    # main loop, waits for connections and starts single threads for every client
     def main(self, soc):
+        if self.bus_path is not None:
+            from workers import BusLink
+            self.bus = BusLink(self, self.bus_path)
+        if self.heartbeat is not None:
+            self.start_heartbeat()
+        if self.federation_port or self.links:
+            self.start_federation()
         while True:
-            client, addr = soc.accept()
+            sock, addr = soc.accept()
+            if self.metrics is not None:
+                self.metrics.inc("connections_accepted")
+            client = Connection(self, sock, addr)
+            self.registry.assign_id(client)
+            client.send(self.greeting)
+            if self.heartbeat is not None:
+                self.heartbeat.watch(client)
+
+            thread = threading.Thread(target=self.handle, args=(client,))
+            thread.daemon = True
+            thread.start()
 
-            client.sendall("NICKNAME".encode())
-            nickname = client.recv(1024).decode()
+    # one thread turns the heartbeat wheel for every connection
+    def start_heartbeat(self):
+        def run():
+            while True:
+                time.sleep(self.heartbeat.wheel.tick)
+                self.heartbeat.tick()
 
-            self.clients.append(client)
-            self.nicknames.append(nickname)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
 
-            self.broadcast("{} connected to the chat!".format(nickname))
+    # opens the federation link port and starts dialing the linked servers
+    def start_federation(self):
+        from federation import Federation
+        listen = (self.federation_host, self.federation_port) if self.federation_port else None
+        self.federation = Federation(self, self.node, listen, self.links, self.link_window, self.link_batch_bytes,
+                                     secret=self.link_secret)
+        self.federation.start()
 
-            thread = threading.Thread(target=self.handle, args=(client,))
-            thread.start()
+    # serves clients on the listening socket until the process is stopped
+    def run(self):
+        if self.stats_port:
+            serve_stats(self, self.stats_port)
+            self.display("Stats at http://127.0.0.1:{0}/stats and http://127.0.0.1:{0}/connections".format(
+                self.stats_port))
+        if self.stats_interval:
+            log_stats(self, self.stats_interval)
+        self.main(self.server_socket)
+
+
+ENGINES = ("thread", "asyncio")
+
+
+# creates a server using the given engine ("thread" or "asyncio"), options go to its constructor
+def create_server(engine, host, port, peers, display=print, **options):
+    if engine == "asyncio":
+        from async_server import AsyncServer
+        return AsyncServer(host, port, peers, display=display, **options)
+    if engine == "thread":
+        return Server(host, port, peers, display=display, **options)
+    raise ValueError("unknown engine {!r}".format(engine))
+
+
+# HOST:PORT of a server to link to
+def parse_address(value):
+    host, sep, port = value.rpartition(":")
+    if not sep or not port.isdigit():
+        raise argparse.ArgumentTypeError("expected HOST:PORT, got {!r}".format(value))
+    return host or "127.0.0.1", int(port)
+
+
+# command line arguments shared by every way of launching the server
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Python chat server")
+    parser.add_argument("--host", default="")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--peers", type=int, default=5, help="listen backlog")
+    parser.add_argument("--engine", choices=ENGINES, default="thread")
+    parser.add_argument("--queue-limit", type=int, default=1024, help="outbound frames queued per client")
+    parser.add_argument("--overflow", choices=POLICIES, default=DROP_OLDEST,
+                        help="what to do when a client's outbound queue is full")
+    parser.add_argument("--block-timeout", type=float, default=5.0,
+                        help="seconds the block policy waits for a full queue")
+    parser.add_argument("--relay", action="store_true", help="forward chat frames without decoding or printing them")
+    parser.add_argument("--flush-window", type=float, default=0.0,
+                        help="seconds to coalesce outbound frames per client before writing, 0 writes at once")
+    parser.add_argument("--flush-bytes", type=int, default=64 * 1024,
+                        help="write a coalesced batch early once this many bytes are queued")
+    parser.add_argument("--history", type=int, default=10000, help="recent messages kept for replay, 0 disables")
+    parser.add_argument("--history-bytes", type=int, default=4 * 1024 * 1024,
+                        help="memory cap of the replay history")
+    parser.add_argument("--metrics", action="store_true", help="collect runtime metrics")
+    parser.add_argument("--stats-port", type=int,
+                        help="serve metrics as JSON on this loopback port, per connection at /connections "
+                             "(worker N of --workers uses port + N)")
+    parser.add_argument("--stats-interval", type=float, help="print metrics as a JSON line every that many seconds")
+    parser.add_argument("--heartbeat", type=float, default=30.0,
+                        help="seconds of silence after which a connection is pinged, 0 disables heartbeats")
+    parser.add_argument("--heartbeat-timeout", type=float, default=30.0,
+                        help="seconds a pinged connection has to answer before it is dropped")
+    parser.add_argument("--rate-messages", type=float, default=20.0,
+                        help="messages per second a client may send on average, 0 for no limit")
+    parser.add_argument("--rate-bytes", type=int, default=256 * 1024,
+                        help="bytes per second a client may send on average, 0 for no limit")
+    parser.add_argument("--rate-burst", type=float, default=2.0,
+                        help="seconds of unused allowance a client may save up for a burst")
+    parser.add_argument("--flood-timeout", type=float, default=10.0,
+                        help="seconds a client may stay over its limit before it is disconnected")
+    parser.add_argument("--store", metavar="DIR",
+                        help="keep every message in append-only logs in this directory, for /history")
+    parser.add_argument("--store-segment-bytes", type=int, default=64 * 1024 * 1024,
+                        help="size at which the store starts a new log segment")
+    parser.add_argument("--store-commit-interval", type=float, default=0.05,
+                        help="seconds the store gathers messages before writing and syncing them together")
+    parser.add_argument("--search", action="store_true", help="index messages for /search")
+    parser.add_argument("--search-postings", type=int, default=2000000,
+                        help="word occurrences the search index keeps before it forgets the oldest messages")
+    parser.add_argument("--compress-min", type=int, default=protocol.COMPRESS_MIN,
+                        help="frames from this size on are deflated for clients that ask for it, 0 disables compression")
+    parser.add_argument("--files", metavar="DIR", help="let clients share files, spooled to this directory")
+    parser.add_argument("--file-max-bytes", type=int, default=64 * 1024 * 1024, help="largest file a client may share")
+    parser.add_argument("--file-spool-bytes", type=int, default=1024 * 1024 * 1024,
+                        help="disk space shared files may take, the oldest are deleted to make room")
+    parser.add_argument("--file-ttl", type=float, default=86400.0,
+                        help="seconds a shared file is kept")
+    parser.add_argument("--node", help="name of this server among linked servers, defaults to hostname:port")
+    parser.add_argument("--federation-port", type=int, help="accept links from other servers on this port")
+    parser.add_argument("--federation-host", default="127.0.0.1",
+                        help="address the federation port listens on, 0.0.0.0 for every interface")
+    parser.add_argument("--link", metavar="HOST:PORT", type=parse_address, action="append", default=[],
+                        help="link to the federation port of another server, may be given several times")
+    parser.add_argument("--link-secret",
+                        help="secret every linked server must share, proven in the handshake without sending it")
+    parser.add_argument("--link-window", type=float, default=0.005,
+                        help="seconds messages to a linked server are gathered to be sent as one batch")
+    parser.add_argument("--link-batch-bytes", type=int, default=64 * 1024,
+                        help="largest batch of messages sent to a linked server at once")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes sharing the port through SO_REUSEPORT, 0 for one per CPU core")
+    return parser.parse_args(argv)
+
+
+# constructor options selected on the command line
+def server_options(args):
+    return {"queue_limit": args.queue_limit, "overflow": args.overflow, "block_timeout": args.block_timeout,
+            "relay": args.relay, "flush_window": args.flush_window, "flush_bytes": args.flush_bytes,
+            "history": args.history, "history_bytes": args.history_bytes, "metrics": args.metrics,
+            "stats_port": args.stats_port, "stats_interval": args.stats_interval, "heartbeat": args.heartbeat,
+            "heartbeat_timeout": args.heartbeat_timeout, "rate_messages": args.rate_messages,
+            "rate_bytes": args.rate_bytes, "rate_burst": args.rate_burst, "flood_timeout": args.flood_timeout,
+            "store": args.store, "store_segment_bytes": args.store_segment_bytes,
+            "store_commit_interval": args.store_commit_interval, "search": args.search,
+            "search_postings": args.search_postings, "compress_min": args.compress_min, "node": args.node,
+            "federation_port": args.federation_port, "federation_host": args.federation_host,
+            "links": args.link, "link_secret": args.link_secret, "link_window": args.link_window,
+            "link_batch_bytes": args.link_batch_bytes, "files": args.files,
+            "file_max_bytes": args.file_max_bytes, "file_spool_bytes": args.file_spool_bytes,
+            "file_ttl": args.file_ttl}
 
 
 if __name__ == "__main__":
-    server = Server("", 12345, 5)
+    args = parse_args()
+    if args.workers != 1:
+        from workers import run_workers
+        run_workers(args)
+    else:
+        server = create_server(args.engine, args.host, args.port, args.peers, **server_options(args))
+        server.run()
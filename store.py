@@ -0,0 +1,262 @@
+import glob
+import mmap
+import os
+import struct
+import threading
+import time
+
+import protocol
+
+# a segment's log holds one record per message: sequence number, wall-clock time and room name length,
+# followed by the room name and the MESSAGE frame as it was sent
+RECORD = struct.Struct("!QdB")
+# its index holds one fixed-size entry per message: sequence number, time and the record's offset in the log
+INDEX = struct.Struct("!QdQ")
+
+SEGMENT_BYTES = 64 * 1024 * 1024
+# messages per history page, and how many records a page request may look at to fill one
+PAGE = 50
+MAX_SCAN = 10000
+
+
+# splits a run of log records into (seq, time, room, frame) tuples
+def parse_records(data):
+    records = []
+    offset = 0
+    while len(data) - offset >= RECORD.size:
+        seq, stamp, size = RECORD.unpack_from(data, offset)
+        start = offset + RECORD.size + size
+        if len(data) - start < protocol.HEADER.size:
+            break
+        end = start + protocol.HEADER.size + protocol.HEADER.unpack_from(data, start)[0]
+        if end > len(data):
+            break
+        room = bytes(data[offset + RECORD.size:start]).decode() or None
+        records.append((seq, stamp, room, bytes(data[start:end])))
+        offset = end
+    return records, offset
+
+
+# one log file and its index, named after the first sequence number in it
+class Segment:
+    def __init__(self, directory, first_seq):
+        self.first_seq = first_seq
+        path = os.path.join(directory, "{:020d}".format(first_seq))
+        self.log = open(path + ".log", "a+b")
+        self.idx = open(path + ".idx", "a+b")
+        self.size = os.fstat(self.log.fileno()).st_size
+        self.entries = 0
+        self.index = None
+        self.remap()
+
+    # maps the committed part of the index, lookups binary search it without reading the file
+    def remap(self):
+        self.entries = os.fstat(self.idx.fileno()).st_size // INDEX.size
+        if self.entries:
+            self.index = mmap.mmap(self.idx.fileno(), self.entries * INDEX.size, access=mmap.ACCESS_READ)
+
+    def entry(self, position):
+        return INDEX.unpack_from(self.index, position * INDEX.size)
+
+    # position of the first entry whose sequence number (field 0) or time (field 1) is at least value
+    def search(self, field, value):
+        low, high = 0, self.entries
+        while low < high:
+            middle = (low + high) // 2
+            if self.entry(middle)[field] < value:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    # records at index positions start to end, read with a single pread
+    def read(self, start, end):
+        if start >= end:
+            return []
+        offset = self.entry(start)[2]
+        stop = self.entry(end)[2] if end < self.entries else self.size
+        return parse_records(os.pread(self.log.fileno(), stop - offset, offset))[0]
+
+    # rebuilds the index from the log and cuts off a record torn by a crash
+    def repair(self):
+        data = os.pread(self.log.fileno(), self.size, 0)
+        records, good = parse_records(data)
+        self.log.truncate(good)
+        self.size = good
+        self.idx.truncate(0)
+        offset = 0
+        entries = bytearray()
+        for seq, stamp, room, frame in records:
+            entries += INDEX.pack(seq, stamp, offset)
+            offset += RECORD.size + len((room or "").encode()) + len(frame)
+        self.idx.write(entries)
+        self.idx.flush()
+        self.remap()
+
+    def last_seq(self):
+        return self.entry(self.entries - 1)[0] if self.entries else None
+
+
+# persistent message history in segmented append-only files; appends are queued and a writer thread
+# commits them in groups with one fsync per group, so the broadcast path never waits for the disk
+class MessageLog:
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, commit_interval=0.05):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.commit_interval = commit_interval
+        firsts = sorted(int(os.path.basename(path)[:-4]) for path in glob.glob(os.path.join(directory, "*.log")))
+        self.segments = [Segment(directory, first) for first in firsts]
+        if self.segments:
+            self.segments[-1].repair()
+        self.last_seq = last_seq(self.segments)
+        # messages waiting for the writer, and the lock page lookups take while the writer swaps in new segments
+        self.pending = []
+        self.cond = threading.Condition()
+        self.lock = threading.Lock()
+        self.commits = 0
+
+        write_thread = threading.Thread(target=self.write)
+        write_thread.daemon = True
+        write_thread.start()
+
+    # queues a sequenced MESSAGE frame for the next group commit, never blocks on the disk
+    def append(self, seq, room, frame):
+        with self.cond:
+            self.pending.append((seq, time.time(), room, frame))
+            self.last_seq = seq
+            if len(self.pending) == 1:
+                self.cond.notify()
+
+    def write(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+            # give the group some time to grow, one fsync then covers all of it
+            time.sleep(self.commit_interval)
+            with self.cond:
+                batch, self.pending = self.pending, []
+            self.commit(batch)
+
+    def commit(self, batch):
+        segment = self.segments[-1] if self.segments else None
+        if segment is None or segment.size >= self.segment_bytes:
+            segment = Segment(self.directory, batch[0][0])
+            with self.lock:
+                self.segments.append(segment)
+        records = bytearray()
+        entries = bytearray()
+        offset = segment.size
+        for seq, stamp, room, frame in batch:
+            name = (room or "").encode()
+            entries += INDEX.pack(seq, stamp, offset)
+            records += RECORD.pack(seq, stamp, len(name)) + name + frame
+            offset = segment.size + len(records)
+        # the log is durable before the index points into it
+        segment.log.write(records)
+        segment.log.flush()
+        os.fsync(segment.log.fileno())
+        segment.idx.write(entries)
+        segment.idx.flush()
+        os.fsync(segment.idx.fileno())
+        with self.lock:
+            segment.size = offset
+            segment.remap()
+            self.commits += 1
+
+    # up to limit frames for the room (and to everyone) before sequence number before, or the latest
+    # ones if before is None; oldest first
+    def page(self, room, before=None, limit=PAGE):
+        frames = []
+        scanned = 0
+        with self.lock:
+            for segment in reversed(self.segments):
+                if before is not None and segment.first_seq >= before:
+                    continue
+                end = segment.entries if before is None else segment.search(0, before)
+                while end > 0 and len(frames) < limit and scanned < MAX_SCAN:
+                    start = max(0, end - limit)
+                    records = segment.read(start, end)
+                    scanned += len(records)
+                    frames.extend(frame for _, _, entry_room, frame in reversed(records)
+                                  if entry_room is None or entry_room == room)
+                    end = start
+                if len(frames) >= limit or scanned >= MAX_SCAN:
+                    break
+        return frames[:limit][::-1]
+
+    # up to limit frames for the room (and to everyone) sent at or after a unix timestamp, oldest first
+    def page_since(self, room, since, limit=PAGE):
+        frames = []
+        scanned = 0
+        with self.lock:
+            for segment in self.segments:
+                if not segment.entries or segment.entry(segment.entries - 1)[1] < since:
+                    continue
+                start = segment.search(1, since)
+                while start < segment.entries and len(frames) < limit and scanned < MAX_SCAN:
+                    end = min(segment.entries, start + limit)
+                    records = segment.read(start, end)
+                    scanned += len(records)
+                    frames.extend(frame for _, _, entry_room, frame in records
+                                  if entry_room is None or entry_room == room)
+                    start = end
+                if len(frames) >= limit or scanned >= MAX_SCAN:
+                    break
+        return frames[:limit]
+
+    # every stored (seq, time, room, frame) up to sequence number last, oldest first, read a page of
+    # records at a time so appends carry on meanwhile
+    def records(self, last, chunk=PAGE * 20):
+        with self.lock:
+            segments = list(self.segments)
+        for segment in segments:
+            start = 0
+            while True:
+                with self.lock:
+                    end = min(segment.entries, start + chunk)
+                    records = segment.read(start, end)
+                if not records:
+                    break
+                for record in records:
+                    if record[0] > last:
+                        return
+                    yield record
+                start = end
+
+    # the frame of one stored message, None if it is not there
+    def find(self, seq):
+        with self.lock:
+            for segment in reversed(self.segments):
+                if segment.first_seq <= seq:
+                    position = segment.search(0, seq)
+                    if position < segment.entries and segment.entry(position)[0] == seq:
+                        return segment.read(position, position + 1)[0][3]
+                    return None
+        return None
+
+    def stats(self):
+        with self.lock:
+            return {"segments": len(self.segments), "bytes": sum(segment.size for segment in self.segments),
+                    "last_seq": self.last_seq, "commits": self.commits, "pending": len(self.pending)}
+
+
+def last_seq(segments):
+    for segment in reversed(segments):
+        if segment.entries:
+            return segment.last_seq()
+    return 0
+
+
+# highest sequence number kept in any store under a directory, for numbering to carry on after a restart
+def stored_seq(directory):
+    seqs = [0]
+    for log in glob.glob(os.path.join(directory, "**", "*.log"), recursive=True):
+        idx = log[:-4] + ".idx"
+        entries = os.path.getsize(idx) // INDEX.size if os.path.exists(idx) else 0
+        if entries:
+            with open(idx, "rb") as f:
+                f.seek((entries - 1) * INDEX.size)
+                seqs.append(INDEX.unpack(f.read(INDEX.size))[0])
+    return max(seqs)
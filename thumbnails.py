@@ -0,0 +1,83 @@
+import collections
+import queue
+import threading
+
+from PIL import Image
+
+THUMBNAIL_SIZE = (160, 160)
+IMAGE_TYPES = (".png", ".jpg", ".jpeg", ".gif", ".bmp", ".webp")
+# largest image decoded for a thumbnail, shared images come from anyone in the room
+MAX_PIXELS = 32 * 1024 * 1024
+
+Image.MAX_IMAGE_PIXELS = MAX_PIXELS
+
+
+def is_image(name):
+    return name.lower().endswith(IMAGE_TYPES)
+
+
+# thumbnails of image files, decoded and scaled down by a thread of their own the first time one is asked for;
+# only the capacity most recently used ones are kept, evicted(path) is called for each one dropped
+class ThumbnailCache:
+    def __init__(self, capacity=64, size=THUMBNAIL_SIZE, evicted=None):
+        self.capacity = capacity
+        self.size = size
+        self.evicted = evicted
+        self.images = collections.OrderedDict()
+        # paths handed to the thread, and files that could not be read as images
+        self.requested = set()
+        self.failed = set()
+        self.todo = queue.Queue()
+        self.done = queue.Queue()
+
+        load_thread = threading.Thread(target=self.load)
+        load_thread.daemon = True
+        load_thread.start()
+
+    # the thumbnail of an image file, None until the thread has made it
+    def get(self, path):
+        image = self.images.get(path)
+        if image is not None:
+            self.images.move_to_end(path)
+            return image
+        if path not in self.requested and path not in self.failed:
+            self.requested.add(path)
+            self.todo.put(path)
+        return None
+
+    def load(self):
+        while True:
+            path = self.todo.get()
+            try:
+                with Image.open(path) as image:
+                    # Pillow only refuses twice MAX_IMAGE_PIXELS, between the two it merely warns
+                    if image.width * image.height > MAX_PIXELS:
+                        raise ValueError("{}x{} image is too large".format(image.width, image.height))
+                    # lets JPEG decode at a fraction of the size straight away
+                    image.draft("RGB", self.size)
+                    image.thumbnail(self.size)
+                    thumbnail = image.copy()
+            except Exception:
+                # decoders raise all sorts of errors on crafted files, none may stop the thread
+                thumbnail = None
+            self.done.put((path, thumbnail))
+
+    # takes the thumbnails the thread finished and keeps make(thumbnail) for each, returns their paths;
+    # call it from the thread that owns whatever make creates
+    def collect(self, make):
+        paths = []
+        while True:
+            try:
+                path, thumbnail = self.done.get_nowait()
+            except queue.Empty:
+                return paths
+            self.requested.discard(path)
+            if thumbnail is None:
+                self.failed.add(path)
+                continue
+            self.images[path] = make(thumbnail)
+            paths.append(path)
+            while len(self.images) > self.capacity:
+                old, _ = self.images.popitem(last=False)
+                if self.evicted is not None:
+                    self.evicted(old)
@@ -0,0 +1,161 @@
+import os
+import random
+import threading
+
+import protocol
+
+
+# a file being sent, offset is None until the server said where to carry on
+class Upload:
+    __slots__ = ("id", "path", "name", "size", "file", "offset")
+
+    def __init__(self, transfer_id, path, name, size, file):
+        self.id = transfer_id
+        self.path = path
+        self.name = name
+        self.size = size
+        self.file = file
+        self.offset = None
+
+
+# client side of file sharing: uploads are read from disk one chunk at a time, downloads go to <id>.part
+# in the download directory and get their own name once complete, so a /get of a file that was cut off
+# carries on from what is already there
+class FileTransfers:
+    def __init__(self, display=print, directory="downloads"):
+        self.display = display
+        self.directory = directory
+        self.uploads = {}
+        self.downloads = {}
+        # files announced in the room, by id
+        self.offers = {}
+        self.lock = threading.Lock()
+
+    # turns /send <path> and /get <id> into frames, other lines are left to the caller (None)
+    def command(self, line):
+        name, _, arg = line.strip().partition(" ")
+        arg = arg.strip()
+        if name == "/send" and arg:
+            return self.upload(arg)
+        if name == "/get" and arg.isdigit():
+            return protocol.encode_command("/get {} {}".format(arg, self.partial(int(arg))))
+        return None
+
+    # an OFFER for a file to upload, an empty frame if it can't be read
+    def upload(self, path):
+        try:
+            file = open(path, "rb")
+            size = os.fstat(file.fileno()).st_size
+        except OSError as e:
+            self.display("Can't send {}: {}".format(path, e))
+            return b""
+        if not size:
+            file.close()
+            self.display("Can't send {}: the file is empty".format(path))
+            return b""
+        upload = Upload(random.getrandbits(63) + 1, path, os.path.basename(path), size, file)
+        with self.lock:
+            self.uploads[upload.id] = upload
+        return protocol.encode_offer(upload.id, upload.name, upload.size)
+
+    # offers every unfinished upload again, after connecting anew the server tells where each one carries on
+    def reoffer(self):
+        with self.lock:
+            for upload in self.uploads.values():
+                upload.offset = None
+            return [protocol.encode_offer(upload.id, upload.name, upload.size) for upload in self.uploads.values()]
+
+    # takes a RESUME from the server, the upload starts sending from the offset it names
+    def resumed(self, payload):
+        obj = protocol.decode_json(payload)
+        with self.lock:
+            upload = self.uploads.get(obj.get("id"))
+            if upload is not None and isinstance(obj.get("offset"), int) and 0 <= obj["offset"] <= upload.size:
+                upload.offset = obj["offset"]
+
+    # whether there is a chunk to send
+    def sending(self):
+        with self.lock:
+            return any(upload.offset is not None for upload in self.uploads.values())
+
+    # the next chunk of the uploads that are under way, taking turns between them; None if there is none
+    def next_chunk(self):
+        with self.lock:
+            for upload in list(self.uploads.values()):
+                if upload.offset is None:
+                    continue
+                data = os.pread(upload.file.fileno(), min(protocol.CHUNK_SIZE, upload.size - upload.offset),
+                                upload.offset)
+                if not data:
+                    self.finish_upload(upload, "it got shorter while it was being sent")
+                    continue
+                frame = protocol.encode_chunk(upload.id, upload.offset, data)
+                upload.offset += len(data)
+                # move it to the back, so every upload gets its turn
+                del self.uploads[upload.id]
+                if upload.offset < upload.size:
+                    self.uploads[upload.id] = upload
+                else:
+                    self.finish_upload(upload)
+                return frame
+        return None
+
+    def finish_upload(self, upload, error=None):
+        self.uploads.pop(upload.id, None)
+        upload.file.close()
+        if error:
+            self.display("Sending {} failed: {}".format(upload.name, error))
+        else:
+            self.display("Sent {}".format(upload.name))
+
+    # takes an OFFER from the server and returns it; one with an offset starts a download
+    def offered(self, payload):
+        offer = protocol.parse_offer(payload)
+        if "offset" not in offer:
+            self.offers[offer["id"]] = offer
+            return offer
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.part_path(offer["id"])
+        file = open(path, "r+b" if os.path.exists(path) else "w+b")
+        file.truncate(offer["offset"])
+        with self.lock:
+            previous = self.downloads.pop(offer["id"], None)
+            if previous is not None:
+                previous[1].close()
+            self.downloads[offer["id"]] = (offer, file)
+        return offer
+
+    # writes a CHUNK of a download, returns the saved file's path once the last one arrived
+    def received(self, payload):
+        transfer_id, offset, data = protocol.decode_chunk(payload)
+        with self.lock:
+            download = self.downloads.get(transfer_id)
+            if download is None:
+                return None
+            offer, file = download
+            file.seek(offset)
+            file.write(data)
+            if offset + len(data) < offer["size"]:
+                return None
+            del self.downloads[transfer_id]
+        file.close()
+        path = self.saved_path(transfer_id, offer["name"])
+        os.replace(self.part_path(transfer_id), path)
+        return path
+
+    def part_path(self, transfer_id):
+        return os.path.join(self.directory, "{}.part".format(transfer_id))
+
+    # the file name to save a download under, made unique with its id if the name is taken
+    def saved_path(self, transfer_id, name):
+        path = os.path.join(self.directory, name)
+        if os.path.exists(path):
+            path = os.path.join(self.directory, "{}-{}".format(transfer_id, name))
+        return path
+
+    # bytes of a file already downloaded
+    def partial(self, transfer_id):
+        try:
+            return os.path.getsize(self.part_path(transfer_id))
+        except OSError:
+            return 0
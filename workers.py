@@ -0,0 +1,175 @@
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import tempfile
+import threading
+
+import protocol
+from outbox import BLOCK, Outbox
+from server import create_server, send_buffers, server_options
+from store import stored_seq
+
+# frames a worker may have in flight towards the hub before publishing blocks
+BUS_QUEUE_LIMIT = 64 * 1024
+
+
+# a worker cut off from the bus would split the chat, so it stops and its clients reconnect elsewhere
+def bus_lost(server):
+    server.display("Lost connection to the worker bus, shutting down")
+    os._exit(1)
+
+
+# the bus hub numbers every message, so all workers share one sequence and the same history
+class Hub:
+    def __init__(self, seq=0):
+        self.links = set()
+        self.seq = seq
+
+
+# hub side of the bus: every routed text a worker publishes is numbered and handed to all workers
+class HubLink(asyncio.Protocol):
+    def __init__(self, hub):
+        self.hub = hub
+        self.transport = None
+        self.decoder = protocol.FrameDecoder()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.hub.links.add(self)
+
+    def data_received(self, data):
+        routed = []
+        for _, frame in self.decoder.decode(data):
+            room, inner = protocol.decode_route(protocol.payload_of(frame))
+            self.hub.seq += 1
+            message = protocol.encode_message(self.hub.seq, protocol.payload_of(inner))
+            routed.append(protocol.encode_route(room, message))
+        if not routed:
+            return
+        data = b"".join(routed)
+        for link in self.hub.links:
+            link.transport.write(data)
+
+    def connection_lost(self, exc):
+        self.hub.links.discard(self)
+
+
+async def run_hub(sock, seq=0):
+    hub = Hub(seq)
+    loop = asyncio.get_running_loop()
+    server = await loop.create_unix_server(lambda: HubLink(hub), sock=sock)
+    async with server:
+        await server.serve_forever()
+
+
+# records a numbered message that came back from the hub
+def receive_routed(server, frame):
+    room, message = protocol.decode_route(protocol.payload_of(frame))
+    seq, text = protocol.decode_messages(protocol.MESSAGE, protocol.payload_of(message))[0]
+    server.record(room, bytes(text), seq)
+
+
+# worker side of the bus for the threaded engine: a writer thread publishes, a reader thread delivers
+class BusLink:
+    def __init__(self, server, path):
+        self.server = server
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.outbox = Outbox(BUS_QUEUE_LIMIT, BLOCK, timeout=None)
+
+        for target in (self.read, self.write):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    # queues a frame for the other workers
+    def publish(self, data):
+        self.outbox.put(data)
+
+    def write(self):
+        while True:
+            frames = self.outbox.get_all()
+            if not frames:
+                break
+            send_buffers(self.sock, frames)
+
+    def read(self):
+        decoder = protocol.FrameDecoder()
+        buffer = memoryview(bytearray(protocol.READ_SIZE))
+        while True:
+            nbytes = self.sock.recv_into(buffer)
+            if not nbytes:
+                bus_lost(self.server)
+            for _, frame in decoder.decode(buffer[:nbytes]):
+                receive_routed(self.server, frame)
+
+
+# worker side of the bus for the asyncio engine, runs on the server's event loop
+class AsyncBusLink(asyncio.Protocol):
+    def __init__(self, server):
+        self.server = server
+        self.transport = None
+        self.decoder = protocol.FrameDecoder()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def publish(self, data):
+        self.transport.write(data)
+
+    def data_received(self, data):
+        for _, frame in self.decoder.decode(data):
+            receive_routed(self.server, frame)
+
+    def connection_lost(self, exc):
+        bus_lost(self.server)
+
+
+# entry point of one worker process
+def run_worker(args, bus_path, index):
+    options = server_options(args)
+    if options["stats_port"]:
+        options["stats_port"] += index
+    # every worker sees every message, each keeps its own copy of the store
+    if options["store"]:
+        options["store"] = os.path.join(options["store"], "worker-{}".format(index))
+    server = create_server(args.engine, args.host, args.port, args.peers, reuse_port=True,
+                           bus_path=bus_path, **options)
+    server.run()
+
+
+# starts the worker processes sharing the port (0 means one per CPU core) and runs the bus hub
+def run_workers(args):
+    workers = args.workers or os.cpu_count() or 1
+    if not hasattr(socket, "SO_REUSEPORT"):
+        raise SystemExit("--workers needs SO_REUSEPORT, which this platform does not support")
+    if args.federation_port or args.link:
+        raise SystemExit("--federation-port and --link need a single worker process")
+    # every worker would keep its own list of the files in one spool and count its quota on its own
+    if args.files:
+        raise SystemExit("--files needs a single worker process")
+
+    bus_dir = tempfile.mkdtemp(prefix="pythonchat-")
+    bus_path = os.path.join(bus_dir, "bus.sock")
+    hub_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    hub_socket.bind(bus_path)
+    hub_socket.listen(workers)
+
+    # make a plain kill run the cleanup below as well
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    processes = []
+    for index in range(workers):
+        process = multiprocessing.Process(target=run_worker, args=(args, bus_path, index))
+        process.daemon = True
+        process.start()
+        processes.append(process)
+    try:
+        asyncio.run(run_hub(hub_socket, stored_seq(args.store) if args.store else 0))
+    finally:
+        for process in processes:
+            process.terminate()
+        os.unlink(bus_path)
+        os.rmdir(bus_dir)